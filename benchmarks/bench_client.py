@@ -0,0 +1,148 @@
+"""
+Client throughput benchmark against the local mock Sophos Central.
+
+Reports wall time, requests/s, records/s and peak memory for the partner tenant listing, endpoint and alert
+fetches, the all-tenant fan out and a few cli commands. The mock runs in its own process. Token, config and
+cache live in a throwaway home directory.
+
+    PYTHONPATH=. python benchmarks/bench_client.py [--tenants 20] [--endpoints 2000] [--latency 0.02] ...
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, List, Sequence
+
+root = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(root), str(root / 'benchmarks')]
+
+from mock_central import MockCentral  # noqa: E402
+
+# Runs sophosCli.main() against the mock named in MOCK_CENTRAL_URL, then reports its own peak rss on stderr.
+# VmHWM rather than ru_maxrss, which carries the forking parent's peak across exec.
+_cli_runner = """
+import os, re, resource, sys
+from mock_central import MockCentral
+central = MockCentral()
+central.url = os.environ['MOCK_CENTRAL_URL']
+sys.argv = ['sophosCli.py'] + sys.argv[1:]
+import sophosCli
+with central.patched():
+    try:
+        sophosCli.main()
+    finally:
+        try:
+            peak = int(re.search(r'VmHWM:\\s+(\\d+)', open('/proc/self/status').read()).group(1))
+        except (OSError, AttributeError):
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"maxrss={peak}", file=sys.stderr)
+"""
+
+
+def report(name: str, elapsed: float, requests: int, records: int, peak: float) -> None:
+    print(f"{name.ljust(36)}{elapsed:>8.2f} s{requests:>7}{requests / elapsed:>9.0f} req/s"
+          f"{records:>9}{records / elapsed:>11,.0f} rec/s{peak / 2 ** 20:>9.1f} MiB")
+
+
+def measure(central: MockCentral, name: str, run: Callable[[], Sequence]) -> None:
+    """Timed and memory traced in separate runs, tracemalloc slows everything down."""
+    before = central.remote_stats().get('requests', 0)
+    started = perf_counter()
+    records = len(run())
+    elapsed = perf_counter() - started
+    requests = central.remote_stats().get('requests', 0) - before
+    tracemalloc.start()
+    result = run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    report(name, elapsed, requests, records, peak)
+
+
+def measure_cli(central: MockCentral, home: str, args: List[str], records: int) -> None:
+    cache = Path(home) / 'sophosCache.db'
+    for path in (cache, Path(f"{cache}-wal"), Path(f"{cache}-shm")):
+        if path.exists():
+            path.unlink()
+    env = dict(os.environ, HOME=home, MOCK_CENTRAL_URL=central.url,
+               PYTHONPATH=os.pathsep.join([str(root), str(root / 'benchmarks')]))
+    before = central.remote_stats().get('requests', 0)
+    started = perf_counter()
+    result = subprocess.run([sys.executable, '-c', _cli_runner] + args, env=env, cwd=home, capture_output=True,
+                            text=True)
+    elapsed = perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"sophosCli {' '.join(args)} failed: {result.stderr.strip()}")
+    requests = central.remote_stats().get('requests', 0) - before
+    rss = [line for line in result.stderr.splitlines() if line.startswith('maxrss=')]
+    report(f"cli {' '.join(args)}"[:35], elapsed, requests, records, int(rss[-1][7:]) * 1024 if rss else 0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Client throughput against a local mock Sophos Central.')
+    parser.add_argument('--tenants', type=int, default=20)
+    parser.add_argument('--endpoints', type=int, default=2000, help='Endpoints per tenant.')
+    parser.add_argument('--alerts', type=int, default=500, help='Alerts per tenant.')
+    parser.add_argument('--regions', type=int, default=2)
+    parser.add_argument('--max-page-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every request.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of requests answered 429.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered 503.')
+    parser.add_argument('--no-cli', action='store_true', help='Skip the cli commands.')
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp()
+    # Keep the token cache out of the real home directory, and local requests away from any proxy
+    os.environ['HOME'] = home
+    os.environ['NO_PROXY'] = '127.0.0.1,localhost'
+    # Every retried 429 and 503 would otherwise be logged in full
+    logging.basicConfig(level=logging.CRITICAL)
+    from sophosApi.apiClient import ApiClient
+    from sophosApi.partnerApi import PartnerApi
+    from sophosApi.rateLimit import RateLimiter
+
+    with MockCentral(args.tenants, args.endpoints, args.alerts, args.regions, args.max_page_size, args.latency,
+                     args.throttle_rate, 0, args.error_rate) as central, central.patched():
+        print(f"{args.tenants} tenants over {args.regions} regions, {args.endpoints} endpoints and {args.alerts} "
+              f"alerts each, {args.latency * 1000:g} ms latency\n")
+        # The default limiter would dominate every number, only the server's 429s should hold us back
+        client = ApiClient('bench', 'bench', limiter=RateLimiter(rate=10000, burst=10000))
+        iam = client._whoami.id
+        tenants = list(PartnerApi(client._request, iam).tenants.values())
+        first = tenants[0]
+        handle = lambda: client.tenant(first.id, first.apiHost, first.name)
+
+        measure(central, 'PartnerApi.tenants', lambda: list(PartnerApi(client._request, iam).tenants))
+        measure(central, 'Endpoints.fetch_all', lambda: handle().endpoints.fetch_all())
+        measure(central, 'Endpoints.fetch_all pipelined', lambda: handle().endpoints.fetch_all(pipelined=True))
+        measure(central, 'Endpoints.fetch_columns pipelined',
+                lambda: handle().endpoints.fetch_columns(pipelined=True))
+        measure(central, 'Alerts.fetch_all', lambda: handle().alerts.fetch_all())
+        measure(central, 'Alerts.fetch_all pipelined', lambda: handle().alerts.fetch_all(pipelined=True))
+        measure(central, 'ApiClient.all_endpoints',
+                lambda: [e for t, result, error in client.all_endpoints(tenants=tenants) for e in result or []])
+        measure(central, 'ApiClient.all_alerts',
+                lambda: [a for t, result, error in client.all_alerts(tenants=tenants) for a in result or []])
+        print(f"\nconnections {client.sessions.stats()}")
+        client.close()
+
+        if args.no_cli:
+            return
+        print()
+        (Path(home) / 'sophosCli.ini').write_text(f"[DEFAULT]\nclient_id = bench\nclient_token = bench\n"
+                                                  f"log_level = WARNING\nidentity = {first.id}\n")
+        measure_cli(central, home, ['tenant', 'list'], args.tenants)
+        measure_cli(central, home, ['endpoint', 'list'], args.endpoints)
+        measure_cli(central, home, ['alert', 'list'], args.alerts)
+        measure_cli(central, home, ['endpoint', 'list', '--all-tenants'], args.tenants * args.endpoints)
+        measure_cli(central, home, ['export', 'endpoints', '--all-tenants', '--format', 'jsonl', '--output',
+                                    os.devnull], args.tenants * args.endpoints)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Record decoding benchmark on synthetic pages.
+
+Compares the original strptime based conversion with parse_timestamp and the column stores.
+
+    PYTHONPATH=. python benchmarks/bench_decode.py [records]
+"""
+import sys
+import tracemalloc
+from datetime import datetime
+from random import Random
+from time import perf_counter
+
+from sophosApi.commonApi import Alert, AlertColumns, _dict_to_alert
+from sophosApi.endpointApi import Endpoint, EndpointColumns, _dict_to_endpoint
+from sophosApi.helpers import parse_timestamp
+
+_format = "%Y-%m-%dT%H:%M:%S.%f%z"
+
+
+def endpoint_items(count: int, seed: int = 1):
+    rnd = Random(seed)
+    return [{'id': f"{i:08x}-0000-0000-0000-000000000000",
+             'type': 'computer',
+             'tenant': {'id': 'tenant'},
+             'hostname': f"HOST-{i}",
+             'health': {'overall': rnd.choice(['good', 'suspicious', 'bad'])},
+             'os': {'name': 'Windows 10 Pro'},
+             'ipv4Addresses': [f"10.0.{i // 256 % 256}.{i % 256}"],
+             'macAddresses': ['00:11:22:33:44:55'],
+             'group': {'name': 'Workstations'},
+             'tamperProtectionEnabled': True,
+             'lastSeenAt': f"2021-{rnd.randint(1, 12):02}-{rnd.randint(1, 28):02}T{rnd.randint(0, 23):02}:"
+                           f"{rnd.randint(0, 59):02}:{rnd.randint(0, 59):02}.{rnd.randint(0, 999):03}Z"}
+            for i in range(count)]
+
+
+def alert_items(count: int, seed: int = 2):
+    rnd = Random(seed)
+    return [{'id': f"{i:08x}-1111-1111-1111-111111111111",
+             'allowedActions': ['acknowledge'],
+             'category': 'malware',
+             'description': 'Malware detected',
+             'groupKey': 'key',
+             'managedAgent': {'id': 'agent'},
+             'product': 'endpoint',
+             'raisedAt': f"2021-{rnd.randint(1, 12):02}-{rnd.randint(1, 28):02}T{rnd.randint(0, 23):02}:"
+                         f"{rnd.randint(0, 59):02}:{rnd.randint(0, 59):02}.{rnd.randint(0, 999):03}Z",
+             'severity': 'high',
+             'tenant': {'id': 'tenant'},
+             'type': 'Event::Endpoint::Threat::Detected'}
+            for i in range(count)]
+
+
+def strptime_endpoint(d):
+    """Conversion as it was before parse_timestamp."""
+    return Endpoint(d['id'], d['type'], d['tenant']['id'], d['hostname'], d.get('health', {}).get('overall'),
+                    d['os'].get('name'), d.get('ipv4Addresses', []) + d.get('ipv6Addresses', []),
+                    d.get('macAddresses'), d.get('group', {}).get('name'), d.get('tamperProtectionEnabled'),
+                    datetime.strptime(d['lastSeenAt'], _format))
+
+
+def strptime_alert(d):
+    """Conversion as it was before parse_timestamp."""
+    return Alert(d['id'], d.get('allowedActions', list()), d.get('category'), d.get('description'),
+                 d.get('groupKey'), d.get('managedAgent', {}).get('id'), d.get('product'),
+                 datetime.strptime(d['raisedAt'], _format), d.get('severity'), d.get('tenant', {}).get('id'),
+                 d.get('type'))
+
+
+def measure(name: str, build, items) -> None:
+    """Timed and memory traced in separate runs, tracemalloc slows everything down."""
+    parse_timestamp.cache_clear()
+    started = perf_counter()
+    build(items)
+    elapsed = perf_counter() - started
+    parse_timestamp.cache_clear()
+    tracemalloc.start()
+    result = build(items)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    print(f"{name.ljust(40)}{len(items) / elapsed:>14,.0f} records/s{size / 2 ** 20:>10.1f} MiB")
+
+
+def main(count: int = 100000) -> None:
+    print(f"{count:,} records\n")
+    for label, items, before, after, columns in (
+            ('endpoints', endpoint_items(count), strptime_endpoint, _dict_to_endpoint, EndpointColumns),
+            ('alerts', alert_items(count), strptime_alert, _dict_to_alert, AlertColumns)):
+        measure(f"{label}: strptime (before)", lambda i: [before(d) for d in i], items)
+        measure(f"{label}: parse_timestamp", lambda i: [after(d) for d in i], items)
+        measure(f"{label}: columns, lazy timestamps", columns, items)
+        print()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
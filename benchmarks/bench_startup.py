@@ -0,0 +1,55 @@
+"""
+Cli startup benchmark for commands that need no network.
+
+Runs each command in a fresh interpreter against a throwaway home directory holding a config with dummy
+credentials, so nothing touches the real config, cache or token, and any attempt to reach the api fails.
+
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+cli = Path(__file__).resolve().parent.parent / 'sophosCli.py'
+
+commands = [
+    ['--help'],
+    ['tenant', 'enter', '00000000-0000-0000-0000-000000000000'],
+    ['tenant', 'exit'],
+    ['cache', 'stats'],
+    ['cache', 'clear'],
+]
+
+
+def run(home: str, args) -> float:
+    # Point every proxy at a closed port so a command that does go to the network fails fast and loudly
+    env = dict(os.environ, HOME=home, HTTPS_PROXY='http://127.0.0.1:9', HTTP_PROXY='http://127.0.0.1:9')
+    started = perf_counter()
+    result = subprocess.run([sys.executable, str(cli)] + args, env=env, capture_output=True, text=True)
+    elapsed = perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed: {result.stderr.strip()}")
+    return elapsed
+
+
+def main(runs: int = 10) -> None:
+    with tempfile.TemporaryDirectory() as home:
+        (Path(home) / 'sophosCli.ini').write_text('[DEFAULT]\nclient_id = id\nclient_token = token\n'
+                                                  'log_level = WARNING\n')
+        started = perf_counter()
+        for _ in range(runs):
+            subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        baseline = (perf_counter() - started) / runs
+        print(f"{'python -c pass'.ljust(50)}\t{baseline * 1000:7.1f} ms")
+        for args in commands:
+            times = [run(home, args) for _ in range(runs)]
+            print(f"{' '.join(args).ljust(50)}\t{median(times) * 1000:7.1f} ms median\t"
+                  f"{min(times) * 1000:7.1f} ms min")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,358 @@
+"""
+Local stand-in for Sophos Central, for benchmarks and offline checks.
+
+Serves the routes sophosApi uses: the oauth2 token, whoami/v1 and partner/v1/tenants on a global host, and
+endpoint/v1/endpoints and common/v1/alerts on one host per region. Tenants are spread over the regions and only
+answer on their own host. Latency, 429s and 5xxs can be injected. Records are generated deterministically from
+the seed.
+
+    python benchmarks/mock_central.py --tenants 20 --endpoints 500 --regions 2 --latency 0.02
+
+prints the global url and serves until interrupted. From python, MockCentral.start() serves from a background
+process, and MockCentral.patched() points sophosApi at it.
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Lock, Thread
+from time import sleep
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+partner_id = '00000000-aaaa-aaaa-aaaa-000000000000'
+_health = ['good', 'good', 'good', 'suspicious', 'bad', 'unknown']
+_os = ['Windows 10 Pro', 'Windows 11 Enterprise', 'Windows Server 2019', 'macOS 13', 'Ubuntu 22.04']
+
+
+def _stamp(rnd: Random) -> str:
+    return (f"2021-{rnd.randint(1, 12):02}-{rnd.randint(1, 28):02}T{rnd.randint(0, 23):02}:"
+            f"{rnd.randint(0, 59):02}:{rnd.randint(0, 59):02}.{rnd.randint(0, 999):03}Z")
+
+
+class _Data(object):
+    """Generated tenants, endpoints and alerts. Endpoints and alerts are built per tenant on first request."""
+
+    def __init__(self, tenants: int, endpoints: int, alerts: int, regions: List[str], seed: int) -> None:
+        self.endpoint_count = endpoints
+        self.alert_count = alerts
+        self.seed = seed
+        self.tenants = [{'id': f"{i:08x}-bbbb-bbbb-bbbb-{seed:012x}",
+                         'name': f"Tenant {i} Ltd",
+                         'dataGeography': 'US',
+                         'dataRegion': f"region{i % len(regions)}",
+                         'billingType': 'usage',
+                         'partner': {'id': partner_id},
+                         'organization': {'id': partner_id},
+                         'apiHost': regions[i % len(regions)]}
+                        for i in range(tenants)]
+        self.by_id = dict([(t['id'], t) for t in self.tenants])
+        self._records: Dict[str, Dict[str, List[Dict]]] = {}
+        self._lock = Lock()
+
+    def records(self, t_id: str, resource: str) -> List[Dict]:
+        with self._lock:
+            if t_id not in self._records:
+                self._records[t_id] = {'endpoints': self._endpoints(t_id), 'alerts': self._alerts(t_id)}
+            return self._records[t_id][resource]
+
+    def _endpoints(self, t_id: str) -> List[Dict]:
+        rnd = Random(f"{self.seed}-{t_id}-endpoints")
+        return [{'id': f"{t_id[:8]}-{i:04x}-cccc-cccc-{i:012x}",
+                 'type': rnd.choice(['computer', 'computer', 'server']),
+                 'tenant': {'id': t_id},
+                 'hostname': f"HOST-{t_id[:4]}-{i}",
+                 'health': {'overall': rnd.choice(_health)},
+                 'os': {'name': rnd.choice(_os)},
+                 'ipv4Addresses': [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"],
+                 'macAddresses': [':'.join(f"{rnd.randint(0, 255):02x}" for _ in range(6))],
+                 'group': {'name': rnd.choice(['Workstations', 'Servers', 'Laptops'])},
+                 'tamperProtectionEnabled': rnd.random() < 0.9,
+                 'lastSeenAt': _stamp(rnd)}
+                for i in range(self.endpoint_count)]
+
+    def _alerts(self, t_id: str) -> List[Dict]:
+        rnd = Random(f"{self.seed}-{t_id}-alerts")
+        return [{'id': f"{t_id[:8]}-{i:04x}-dddd-dddd-{i:012x}",
+                 'allowedActions': ['acknowledge'],
+                 'category': rnd.choice(['malware', 'policy', 'updating']),
+                 'description': 'Malware detected',
+                 'groupKey': f"key-{i % 17}",
+                 'managedAgent': {'id': f"{t_id[:8]}-{rnd.randrange(max(1, self.endpoint_count)):04x}"},
+                 'product': 'endpoint',
+                 'raisedAt': _stamp(rnd),
+                 'severity': rnd.choice(['low', 'medium', 'high']),
+                 'tenant': {'id': t_id},
+                 'type': 'Event::Endpoint::Threat::Detected'}
+                for i in range(self.alert_count)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set on the subclass made for each server
+    central: 'MockCentral' = None
+    host_url: str = None
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: Optional[Dict] = None, headers: Optional[Dict] = None) -> None:
+        data = json.dumps(body if body is not None else {}).encode()
+        if self.central.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, 1)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method: str) -> None:
+        central = self.central
+        parts = urlsplit(self.path)
+        path = parts.path.rstrip('/')
+        query = dict([(k, v[-1]) for k, v in parse_qs(parts.query).items()])
+        if method == 'POST':
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if path == '/_stats':
+            return self._send(200, central.stats())
+        central.count('requests')
+        central.count(f"{method} {self._route(path)}")
+        if central.latency:
+            sleep(central.latency)
+        if central.rnd() < central.throttle_rate:
+            central.count('status_429')
+            return self._send(429, {'error': 'TooManyRequests'}, {'Retry-After': str(central.retry_after)})
+        if central.rnd() < central.error_rate:
+            central.count('status_503')
+            return self._send(503, {'error': 'ServiceUnavailable'})
+        if path == '/api/v2/oauth2/token' and method == 'POST':
+            central.count('tokens')
+            return self._send(200, {'access_token': f"mock-token-{central.counter('tokens')}",
+                                    'token_type': 'bearer', 'expires_in': central.token_ttl})
+        if not self.headers.get('Authorization', '').startswith('Bearer mock-token-'):
+            return self._send(401, {'error': 'Unauthorized'})
+        if self.host_url == central.url:
+            return self._global(method, path, query)
+        return self._regional(method, path, query)
+
+    @staticmethod
+    def _route(path: str) -> str:
+        """Path with ids replaced, to count requests per route."""
+        segments = path.split('/')
+        if len(segments) > 4 and segments[3] in ('endpoints', 'alerts'):
+            segments[4] = '{id}'
+        return '/'.join(segments)
+
+    def _global(self, method: str, path: str, query: Dict) -> None:
+        central = self.central
+        if path == '/whoami/v1' and method == 'GET':
+            return self._send(200, {'id': partner_id, 'idType': 'partner', 'apiHosts': {'global': central.url}})
+        if path == '/partner/v1/tenants' and method == 'GET':
+            if self.headers.get('X-Partner-ID') != partner_id:
+                return self._send(403, {'error': 'Forbidden'})
+            size = min(int(query.get('pageSize', 50)), 100)
+            page = int(query.get('page', 1))
+            tenants = central.data.tenants
+            pages = {'current': page, 'size': size, 'maxSize': 100}
+            if query.get('pageTotal') == 'true':
+                pages.update(total=max(1, -(-len(tenants) // size)), items=len(tenants))
+            return self._send(200, {'items': tenants[(page - 1) * size:page * size], 'pages': pages})
+        if path.startswith('/partner/v1/tenants/') and method == 'GET':
+            tenant = central.data.by_id.get(path.rsplit('/', 1)[1])
+            return self._send(200, tenant) if tenant else self._send(404, {'error': 'NotFound'})
+        return self._send(404, {'error': 'NotFound'})
+
+    def _regional(self, method: str, path: str, query: Dict) -> None:
+        central = self.central
+        tenant = central.data.by_id.get(self.headers.get('X-Tenant-ID'))
+        if tenant is None or tenant['apiHost'] != self.host_url:
+            return self._send(403, {'error': 'Forbidden'})
+        segments = path.split('/')
+        if len(segments) < 4 or (segments[1], segments[3]) not in (('endpoint', 'endpoints'), ('common', 'alerts')):
+            return self._send(404, {'error': 'NotFound'})
+        records = central.data.records(tenant['id'], segments[3])
+        if len(segments) == 4 and method == 'GET':
+            max_size = central.max_page_size
+            size = min(int(query.get('pageSize', 50)), max_size)
+            start = int(query.get('pageFromKey') or 0)
+            items = records[start:start + size]
+            return self._send(200, {'items': items, 'pages': {'fromKey': str(start), 'nextKey': str(start + size),
+                                                              'size': len(items), 'maxSize': max_size}})
+        record = next((r for r in records if r['id'] == segments[4]), None)
+        if record is None:
+            return self._send(404, {'error': 'NotFound'})
+        if len(segments) == 5 and method == 'GET':
+            return self._send(200, record)
+        if len(segments) == 6 and method == 'POST' and segments[5] in ('scans', 'update-checks', 'actions'):
+            return self._send(201, {'id': record['id'], 'status': 'requested'})
+        return self._send(404, {'error': 'NotFound'})
+
+    def do_GET(self) -> None:
+        self._handle('GET')
+
+    def do_POST(self) -> None:
+        self._handle('POST')
+
+
+class MockCentral(object):
+    """Global host plus one host per region, all on 127.0.0.1."""
+
+    def __init__(self, tenants: int = 10, endpoints: int = 200, alerts: int = 100, regions: int = 2,
+                 max_page_size: int = 500, latency: float = 0.0, throttle_rate: float = 0.0, retry_after: float = 0,
+                 error_rate: float = 0.0, token_ttl: int = 3600, compress: bool = True, seed: int = 1) -> None:
+        """
+        :param int tenants: tenants of the partner
+        :param int endpoints: endpoints per tenant
+        :param int alerts: alerts per tenant
+        :param int regions: regional api hosts the tenants are spread over
+        :param int max_page_size: largest endpoint and alert page, reported as pages.maxSize
+        :param float latency: seconds added to every request
+        :param float throttle_rate: share of requests answered 429 with Retry-After retry_after
+        :param float error_rate: share of requests answered 503
+        :param bool compress: gzip responses when the client accepts it
+        """
+        self.options = dict(tenants=tenants, endpoints=endpoints, alerts=alerts, regions=regions,
+                            max_page_size=max_page_size, latency=latency, throttle_rate=throttle_rate,
+                            retry_after=retry_after, error_rate=error_rate, token_ttl=token_ttl, compress=compress,
+                            seed=seed)
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.compress = compress
+        self._random = Random(seed)
+        self._counts = Counter()
+        self._lock = Lock()
+        self._servers = []
+        self._process = None
+        self.url = None
+        self.region_urls = []
+        self.data = None
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def counter(self, name: str) -> int:
+        with self._lock:
+            return self._counts[name]
+
+    def rnd(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def _server(self) -> ThreadingHTTPServer:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        server.daemon_threads = True
+        self._servers.append(server)
+        return server
+
+    def serve(self) -> None:
+        """Bind every host and serve from background threads of this process."""
+        servers = [self._server() for _ in range(1 + self.options['regions'])]
+        urls = [f"http://127.0.0.1:{server.server_port}" for server in servers]
+        self.url, self.region_urls = urls[0], urls[1:]
+        self.data = _Data(self.options['tenants'], self.options['endpoints'], self.options['alerts'],
+                          self.region_urls, self.options['seed'])
+        for server, url in zip(servers, urls):
+            server.RequestHandlerClass = type('Handler', (_Handler,), {'central': self, 'host_url': url})
+            Thread(target=server.serve_forever, daemon=True).start()
+
+    def start(self) -> 'MockCentral':
+        """Serve from a child process, so the server neither shares the GIL with nor adds to the memory of the
+        client being measured. Only url and region_urls are available in this process."""
+        parent, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve_child, args=(self.options, child), daemon=True)
+        self._process.start()
+        self.url, self.region_urls = parent.recv()
+        return self
+
+    def remote_stats(self) -> Dict[str, int]:
+        """Request counters of a server started with start()."""
+        import requests
+        return requests.get(f"{self.url}/_stats", timeout=10).json()
+
+    def stop(self) -> None:
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self) -> 'MockCentral':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    @contextmanager
+    def patched(self):
+        """Point sophosApi's global urls at this server for the duration."""
+        from sophosApi.asyncClient import AsyncPartnerApi, AsyncWhoamiApi
+        from sophosApi.auth import TokenManager
+        from sophosApi.partnerApi import PartnerApi
+        from sophosApi.whoamiApi import WhoamiApi
+        saved = (TokenManager.token_url, WhoamiApi.baseurl, PartnerApi.baseurl, AsyncWhoamiApi.baseurl,
+                 AsyncPartnerApi.baseurl)
+        TokenManager.token_url = f"{self.url}/api/v2/oauth2/token"
+        WhoamiApi.baseurl = AsyncWhoamiApi.baseurl = f"{self.url}/whoami/v1"
+        PartnerApi.baseurl = AsyncPartnerApi.baseurl = f"{self.url}/partner/v1/"
+        try:
+            yield self
+        finally:
+            (TokenManager.token_url, WhoamiApi.baseurl, PartnerApi.baseurl, AsyncWhoamiApi.baseurl,
+             AsyncPartnerApi.baseurl) = saved
+
+
+def _serve_child(options: Dict, pipe) -> None:
+    central = MockCentral(**options)
+    central.serve()
+    pipe.send((central.url, central.region_urls))
+    while True:
+        sleep(3600)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Local stand-in for Sophos Central.')
+    parser.add_argument('--tenants', type=int, default=10)
+    parser.add_argument('--endpoints', type=int, default=200, help='Endpoints per tenant.')
+    parser.add_argument('--alerts', type=int, default=100, help='Alerts per tenant.')
+    parser.add_argument('--regions', type=int, default=2)
+    parser.add_argument('--max-page-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of requests answered 429.')
+    parser.add_argument('--retry-after', type=float, default=0, help='Retry-After sent with 429s.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered 503.')
+    parser.add_argument('--no-compress', action='store_true')
+    args = parser.parse_args()
+    central = MockCentral(args.tenants, args.endpoints, args.alerts, args.regions, args.max_page_size, args.latency,
+                          args.throttle_rate, args.retry_after, args.error_rate, compress=not args.no_compress)
+    central.serve()
+    print(f"Global {central.url}")
+    for url in central.region_urls:
+        print(f"Region {url}")
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        central.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -26,5 +26,9 @@ setup(
     ),
     keywords='sophos cli automation',
     install_requires=['requests',],
+    extras_require={
+        'async': ['aiohttp'],
+        'parquet': ['pyarrow'],
+    },
     zip_safe=False
 )
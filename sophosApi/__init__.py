@@ -1,5 +1,11 @@
-from sophosApi.apiClient import ApiClient
-
 __all__ = [
     'ApiClient'
 ]
+
+
+def __getattr__(name):
+    # Importing the client pulls in requests, so only do it when it is asked for
+    if name == 'ApiClient':
+        from sophosApi.apiClient import ApiClient
+        return ApiClient
+    raise AttributeError(f"module 'sophosApi' has no attribute {name}")
@@ -6,42 +6,201 @@ Email: matt.jenkins@dataprise.com
 
 Version: 1.0.0
 """
-from typing import Dict
+import logging
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock, RLock
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, Iterator, NamedTuple, Optional
+from urllib.parse import urlsplit
 
 import requests
 
 import sophosApi.partnerApi as partnerApi
 import sophosApi.whoamiApi as whoamiApi
 from sophosApi.auth import Auth
-from sophosApi.helpers import backoff_handler
+from sophosApi.connections import SessionPool
+from sophosApi.helpers import backoff_handler, coalesce_handler
+from sophosApi.rateLimit import RateLimiter
 
 __all__ = [
-    'ApiClient'
+    'ApiClient',
+    'TenantResult'
 ]
 
 
+class TenantResult(NamedTuple):
+    tenant: partnerApi.Tenant
+    result: Any
+    error: Optional[BaseException]
+
+
 class ApiClient(object):
     _request: requests.request
     _whoami: whoamiApi.IAm
     tenants: Dict[str, partnerApi.Tenant]
 
-    def __init__(self, c_id: str, c_token: str) -> None:
-        """loads initial state"""
+    def __init__(self, c_id: str, c_token: str, ttl: int = 300, limiter: Optional[RateLimiter] = None,
+                 sessions: Optional[SessionPool] = None, coalesce: bool = True) -> None:
+        """loads initial state
+        :param int ttl: seconds whoami and tenant lookups are memoized for
+        :param RateLimiter limiter: rate limits and retry budget, limiter.stats() has throttle and retry counts
+        :param SessionPool sessions: connection pools and timeouts per api host, sessions.stats() has pool usage
+        :param bool coalesce: identical GETs in flight at once share one request, see coalesce_handler
+        """
         # All requests to be wrapped with oauth and backoff handler
         auth = Auth(c_id, c_token)
-        self._session = requests.Session()
-        self._request = auth.oauth_handler(backoff_handler(self._session.request))
+        self.limiter = limiter or RateLimiter()
+        self.sessions = sessions or SessionPool()
+        self._request = auth.oauth_handler(backoff_handler(self.sessions.request, self.limiter))
+        if coalesce:
+            self._request = coalesce_handler(self._request)
+        self.ttl = ttl
+        self._memo = {}
+        self._memo_lock = RLock()
+
+    def _memoized(self, key, factory: Callable[[], Any]) -> Any:
+        with self._memo_lock:
+            hit = self._memo.get(key)
+        if hit is not None and hit[0] > monotonic():
+            return hit[1]
+        value = factory()
+        with self._memo_lock:
+            self._memo[key] = (monotonic() + self.ttl, value)
+        return value
+
+    def _peek(self, key) -> Any:
+        """Memoized value if still fresh, without computing it."""
+        with self._memo_lock:
+            hit = self._memo.get(key)
+        if hit is not None and hit[0] > monotonic():
+            return hit[1]
+        return None
+
+    def invalidate(self, tenant: Optional[str] = None) -> None:
+        """Forget memoized lookups. Given a tenant id, only that tenant is forgotten."""
+        with self._memo_lock:
+            if tenant is None:
+                self._memo.clear()
+                return
+            self._memo.pop(('tenant', tenant), None)
+            tenants = self._peek('tenants')
+            if tenants is not None and tenant in tenants:
+                self._memo.pop('tenants')
+
+    @property
+    def _whoami(self) -> whoamiApi.IAm:
+        return self._memoized('whoami', lambda: whoamiApi.WhoamiApi(self._request).whoami)
 
     @property
-    def _whoami(self):
-        return whoamiApi.WhoamiApi(self._request).whoami
+    def _partner(self) -> partnerApi.PartnerApi:
+        return partnerApi.PartnerApi(self._request, self._whoami.id)
 
     @property
     def tenants(self) -> Dict[str, partnerApi.Tenant]:
-        return partnerApi.PartnerApi(self._request, self._whoami.id).tenants
+        return self._memoized('tenants', lambda: self._partner.tenants)
 
     def __getitem__(self, item) -> partnerApi.Tenant:
-        return partnerApi.PartnerApi(self._request, self._whoami.id)[item]
+        tenants = self._peek('tenants')
+        if tenants is not None and item in tenants:
+            return tenants[item]
+        return self._memoized(('tenant', item), lambda: self._partner[item])
+
+    def tenant(self, t_id: str, apiHost: str, name: Optional[str] = None,
+               on_moved: Optional[Callable[[partnerApi.Tenant], None]] = None) -> partnerApi.Tenant:
+        """Tenant from a cached id and apiHost, requests go straight to the regional host.
+        If the regional host rejects the tenant, the partner api is asked for its current apiHost and the request
+        is retried there. That happens at most once every ttl seconds per handle.
+        :param on_moved: called with the freshly resolved Tenant when its apiHost has changed, to update caches
+        """
+        # Shared by every thread using the handle, e.g. fan_out and bulk action workers
+        current = {'apiHost': apiHost, 'resolved_at': None}
+        lock = Lock()
+
+        def rejected(url: str, status_code: int) -> bool:
+            """Whether the regional host refused the tenant itself, not just a missing endpoint or alert.
+            Collection routes are /<api>/v1/<collection>, anything deeper names an item.
+            """
+            if status_code == 403:
+                return True
+            return status_code == 404 and len(urlsplit(url).path.strip('/').split('/')) <= 3
+
+        def regional(method, url, *args, **kwargs) -> requests.Response:
+            with lock:
+                host = current['apiHost']
+            if host != apiHost and url.startswith(apiHost):
+                url = host + url[len(apiHost):]
+            result = self._request(method, url, *args, **kwargs)
+            if not rejected(url, result.status_code):
+                return result
+            with lock:
+                if current['resolved_at'] is not None and monotonic() - current['resolved_at'] < self.ttl:
+                    return result
+                current['resolved_at'] = monotonic()
+            self.invalidate(t_id)
+            try:
+                moved = self[t_id]
+            except KeyError:
+                return result
+            with lock:
+                if moved.apiHost == current['apiHost']:
+                    return result
+                logging.warning(f"Tenant {t_id} moved from {current['apiHost']} to {moved.apiHost}")
+                url = moved.apiHost + url[len(current['apiHost']):]
+                current['apiHost'] = moved.apiHost
+            if on_moved is not None:
+                on_moved(moved)
+            return self._request(method, url, *args, **kwargs)
+
+        return partnerApi.tenant_handle(regional, t_id, apiHost, name)
+
+    def fan_out(self, func: Callable[[partnerApi.Tenant], Any],
+                tenants: Optional[Iterable[partnerApi.Tenant]] = None,
+                max_workers: int = 16, per_host: int = 4) -> Iterator[TenantResult]:
+        """Run func against every tenant on a bounded worker pool.
+        Results are yielded as each tenant finishes, in completion order. Exceptions raised by func are
+        collected on the TenantResult instead of aborting the run.
+        :param func: called with a Tenant, its return value is placed in TenantResult.result
+        :param tenants: tenants to run against, defaults to every tenant of the partner
+        :param int max_workers: total concurrent tenants
+        :param int per_host: concurrent tenants per apiHost
+        """
+        if tenants is None:
+            tenants = self.tenants.values()
+        pending = defaultdict(deque)
+        for tenant in tenants:
+            pending[tenant.apiHost].append(tenant)
+        running = defaultdict(int)
+        futures = dict()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or futures:
+                # Fill free worker slots, respecting the per host limit
+                for host in list(pending):
+                    while pending[host] and running[host] < per_host and len(futures) < max_workers:
+                        tenant = pending[host].popleft()
+                        futures[executor.submit(func, tenant)] = tenant
+                        running[host] += 1
+                    if not pending[host]:
+                        del pending[host]
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tenant = futures.pop(future)
+                    running[tenant.apiHost] -= 1
+                    error = future.exception()
+                    if error is not None:
+                        logging.error(f"Tenant {tenant.id} failed: {error}")
+                        yield TenantResult(tenant, None, error)
+                    else:
+                        yield TenantResult(tenant, future.result(), None)
+
+    def all_alerts(self, **kwargs) -> Iterator[TenantResult]:
+        """Fetch alerts for every tenant. See fan_out for keyword arguments."""
+        return self.fan_out(lambda t: t.alerts.fetch_all(), **kwargs)
+
+    def all_endpoints(self, **kwargs) -> Iterator[TenantResult]:
+        """Fetch endpoints for every tenant. See fan_out for keyword arguments."""
+        return self.fan_out(lambda t: t.endpoints.fetch_all(), **kwargs)
 
     def close(self):
-        self._session.close()
+        self.sessions.close()
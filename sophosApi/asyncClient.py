@@ -0,0 +1,471 @@
+"""
+Sophos Api asyncio Client.
+
+Same object model as ApiClient (tenants, Alerts, Endpoints, whoami) on top of aiohttp.
+Install with the async extra: pip install sophosCli[async]
+"""
+import asyncio
+import logging
+from functools import wraps
+from json import loads
+from time import monotonic
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover - optional dependency
+    aiohttp = None
+
+from .auth import TokenManager
+from .commonApi import Alert, Alerts, _dict_to_alert
+from .endpointApi import Endpoint, Endpoints, _dict_to_endpoint
+from .helpers import IncompleteListing, LruCache, _coalesce_key, _shared_json, log_exchange
+from .metrics import metrics, route
+from .rateLimit import RateLimiter
+from .partnerApi import Tenant, _dict_to_tenant
+from .whoamiApi import IAm
+
+__all__ = [
+    'AsyncApiClient',
+    'AsyncAlerts',
+    'AsyncEndpoints',
+    'AsyncPartnerApi',
+    'AsyncWhoamiApi',
+    'AsyncAuth',
+    'async_backoff_handler'
+]
+
+AsyncRequest = Callable[..., Awaitable['Response']]
+
+
+class Response(object):
+    """Fully read aiohttp response, quacks like the parts of requests.Response this package uses."""
+
+    def __init__(self, status_code: int, headers: Dict, url: str, content: bytes) -> None:
+        self.status_code = status_code
+        self.headers = headers
+        self.url = url
+        self.content = content
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return loads(self.content)
+
+
+def _params(params: Optional[Dict]) -> Optional[Dict[str, str]]:
+    """aiohttp only accepts str query values, requests stringifies for us."""
+    if params is None:
+        return None
+    return dict([(k, str(v).lower() if type(v) is bool else str(v)) for k, v in params.items()])
+
+
+def _transport(session: Callable[[], 'aiohttp.ClientSession']) -> AsyncRequest:
+    """:param session: returns the ClientSession to send on, called per request"""
+    async def request(method: str, url: str, params: Optional[Dict] = None, **kwargs) -> Response:
+        async with session().request(method.upper(), url, params=_params(params), **kwargs) as result:
+            return Response(result.status, dict(result.headers), str(result.url), await result.read())
+
+    return request
+
+
+def async_backoff_handler(func: AsyncRequest, limiter: Optional[RateLimiter] = None) -> AsyncRequest:
+    """asyncio equivalent of helpers.backoff_handler"""
+    if limiter is None:
+        limiter = RateLimiter()
+
+    @wraps(func)
+    async def return_function(method: str, url: str, *args, **kwargs) -> Response:
+        key = limiter.key(url, kwargs.get('headers'))
+        started = monotonic()
+        attempt = 0
+        while True:
+            wait = limiter.reserve(key)
+            if wait > 0:
+                metrics.count('throttle_seconds', wait)
+                await asyncio.sleep(wait)
+            attempt += 1
+            sent = monotonic()
+            try:
+                return_result = await func(method, url, *args, **kwargs)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                metrics.request(method.upper(), url, None, monotonic() - sent)
+                logging.error(f'Connection exception happened. {e}')
+                delay = limiter.exception_delay(attempt)
+                if not limiter.allow_retry(attempt, started, delay):
+                    raise
+                metrics.count('retries', reason=type(e).__name__)
+                metrics.count('backoff_seconds', delay)
+                await asyncio.sleep(delay)
+                continue
+            elapsed = monotonic() - sent
+            metrics.request(method.upper(), url, return_result.status_code, elapsed,
+                            int(return_result.headers.get('Content-Length') or len(return_result.content)),
+                            len(return_result.content))
+            log_exchange(method.upper(), url, kwargs.get('headers'), return_result, kwargs.get('json'),
+                         elapsed_ms=elapsed * 1000, wait_ms=wait * 1000, attempt=attempt)
+            delay = limiter.retry_delay(key, return_result.status_code, return_result.headers, attempt)
+            if delay is None:
+                return return_result
+            if return_result.status_code > 499:
+                log_exchange(method.upper(), url, kwargs.get('headers'), return_result, kwargs.get('json'),
+                             level=logging.ERROR)
+            if not limiter.allow_retry(attempt, started, delay):
+                return return_result
+            limiter.hold(key, return_result.headers, delay)
+            metrics.count('retries', reason=str(return_result.status_code))
+            metrics.count('backoff_seconds', delay)
+            logging.warning(f"Backing off for {int(delay * 1000)}ms")
+            await asyncio.sleep(delay)
+
+    return return_function
+
+
+def async_coalesce_handler(func: AsyncRequest) -> AsyncRequest:
+    """asyncio equivalent of helpers.coalesce_handler. The shared call runs as its own task, so cancelling one
+    caller doesn't cancel it for the others."""
+    in_flight: Dict[Tuple, asyncio.Task] = {}
+
+    @wraps(func)
+    async def return_function(method: str, url: str, *args, **kwargs) -> Response:
+        key = None if args else _coalesce_key(method, url, kwargs)
+        if key is None:
+            return await func(method, url, *args, **kwargs)
+        task = in_flight.get(key)
+        if task is None:
+            task = in_flight[key] = asyncio.ensure_future(func(method, url, **kwargs))
+            task.waiters = 0
+            task.add_done_callback(lambda done: in_flight.pop(key, None))
+        else:
+            task.waiters += 1
+            if task.waiters == 1:
+                task.add_done_callback(lambda done: done.cancelled() or done.exception() or
+                                       _shared_json(done.result()))
+            metrics.count('coalesced', route=route(url))
+        return await asyncio.shield(task)
+
+    return return_function
+
+
+class AsyncAuth(object):
+    """asyncio equivalent of Auth. Shares the TokenManager, so concurrent tasks and threads share one refresh."""
+
+    def __init__(self, c_id: str, c_token: str, manager: Optional[TokenManager] = None,
+                 session: Optional[Callable[[], 'aiohttp.ClientSession']] = None) -> None:
+        """:param session: returns the ClientSession to refresh the token through, None to refresh in the executor"""
+        self.c_id = c_id
+        self.c_token = c_token
+        self.manager = manager or TokenManager.for_credentials(c_id, c_token)
+        self.session = session
+
+    def oauth_handler(self, func: AsyncRequest) -> AsyncRequest:
+        @wraps(func)
+        async def return_function(*args, **kwargs) -> Response:
+            headers = dict(kwargs.get('headers') or {})
+            for attempt in range(2):
+                token = await self.manager.token_async(None if self.session is None else self.session())
+                headers.update(Authorization=f"Bearer {token}")
+                kwargs['headers'] = headers
+                result = await func(*args, **kwargs)
+                if result.status_code != 401:
+                    break
+                self.manager.invalidate(token)
+            return result
+
+        return return_function
+
+
+async def _paginate(request: AsyncRequest, url: str, headers: Dict, params: Dict) -> AsyncIterator[List[Dict]]:
+    """Yield the items of each page of a pageFromKey paginated route. Raises IncompleteListing at the first
+    failed page."""
+    params = dict(params)
+    while True:
+        result = await request('get', url, headers=headers, params=params)
+        if not result:
+            logging.error(f"{result.status_code} fetching {url} for {headers}")
+            raise IncompleteListing(f"{result.status_code} fetching {url}")
+        with metrics.timed('json_decode', route=route(url)):
+            json = result.json()
+        metrics.count('pages', route=route(url))
+        yield json['items']
+        if len(json['items']) < int(params['pageSize']):
+            return
+        params['pageFromKey'] = json['pages']['nextKey']
+        params['pageSize'] = json['pages']['maxSize']
+
+
+async def _paginate_pages(request: AsyncRequest, url: str, headers: Dict, params: Dict,
+                          max_workers: int = 8) -> AsyncIterator[List[Dict]]:
+    """asyncio equivalent of helpers.paginate_pages. Page 1 is requested with pageTotal, then the remaining pages
+    concurrently, max_workers at a time, and yielded in page order. Without a page total, pages are fetched one
+    after another until a short page. Raises IncompleteListing at the first failed page."""
+    params = dict(params, page=1)
+
+    def items(result, page: int) -> List[Dict]:
+        if not result:
+            logging.error(f"{result.status_code} fetching page {page} of {url} for {headers}")
+            raise IncompleteListing(f"{result.status_code} fetching {url}")
+        with metrics.timed('json_decode', route=route(url)):
+            json = result.json()
+        metrics.count('pages', route=route(url))
+        return json
+
+    json = items(await request('get', url, headers=headers, params=dict(params, pageTotal='true')), 1)
+    yield json['items']
+    if 'total' not in json['pages']:
+        while len(json['items']) >= int(params['pageSize']):
+            params['page'] += 1
+            params['pageSize'] = json['pages'].get('maxSize', params['pageSize'])
+            json = items(await request('get', url, headers=headers, params=dict(params)), params['page'])
+            yield json['items']
+        return
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def fetch(page: int) -> List[Dict]:
+        async with semaphore:
+            return items(await request('get', url, headers=headers, params=dict(params, page=page)), page)['items']
+
+    tasks = [asyncio.ensure_future(fetch(page)) for page in range(2, int(json['pages']['total']) + 1)]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Retrieved, so a failed page we never reached isn't reported as unhandled
+                task.exception()
+
+
+class AsyncAlerts(object):
+    """asyncio equivalent of commonApi.Alerts"""
+
+    def __init__(self, getter: AsyncRequest, baseurl: str, headers: Dict) -> None:
+        self._request = getter
+        self._headers = headers
+        self._baseurl = baseurl
+        self._current: Dict[str, Alert] = {}
+        self._alerts = LruCache(Alerts.cache_size, Alerts.cache_ttl)
+
+    async def get(self, a_id: str) -> Alert:
+        """https://developer.sophos.com/docs/common-v1/1/routes/alerts/%7BalertId%7D/get"""
+        if a_id in self._current:
+            return self._current[a_id]
+        cached = self._alerts.get(a_id)
+        if cached is not None:
+            return cached
+        result = await self._request('get', f"{self._baseurl}alerts/{a_id}", headers=self._headers)
+        if not result:
+            raise KeyError(a_id)
+        alert = _dict_to_alert(result.json())
+        self._alerts[alert.id] = alert
+        return alert
+
+    async def iter_all(self) -> AsyncIterator[Alert]:
+        """https://developer.sophos.com/docs/common-v1/1/routes/alerts/get"""
+        async for page in _paginate(self._request, f"{self._baseurl}alerts", self._headers, Alerts._params()):
+            for alert in Alerts._convert(page):
+                yield alert
+
+    def __aiter__(self) -> AsyncIterator[Alert]:
+        return self.iter_all()
+
+    async def fetch_all(self) -> List[Alert]:
+        """Fetch all alerts. Overwrites current alerts."""
+        alerts = [alert async for alert in self.iter_all()]
+        self._current = dict([(alert.id, alert) for alert in alerts])
+        return alerts
+
+    async def action(self, a_id: str, action: str) -> bool:
+        result = await self._request('post', f"{self._baseurl}alerts/{a_id}/actions",
+                                     json={'action': action, 'message': 'clear'}, headers=self._headers)
+        if not result:
+            logging.error(f"Unable to action alert {a_id}: {result.status_code} {result.text}")
+            return False
+        return True
+
+
+class AsyncEndpoints(object):
+    """asyncio equivalent of endpointApi.Endpoints"""
+
+    def __init__(self, getter: AsyncRequest, baseurl: str, headers: Dict) -> None:
+        self._request = getter
+        self._headers = headers
+        self._baseurl = baseurl
+        self._current: Dict[str, Endpoint] = {}
+        self._endpoints = LruCache(Endpoints.cache_size, Endpoints.cache_ttl)
+
+    async def get(self, e_id: str) -> Endpoint:
+        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/%7BendpointId%7D/get"""
+        if e_id in self._current:
+            return self._current[e_id]
+        cached = self._endpoints.get(e_id)
+        if cached is not None:
+            return cached
+        result = await self._request('get', f"{self._baseurl}endpoints/{e_id}", headers=self._headers,
+                                     params={"view": "summary"})
+        if not result:
+            raise KeyError(e_id)
+        endpoint = _dict_to_endpoint(result.json())
+        self._endpoints[endpoint.id] = endpoint
+        return endpoint
+
+    async def iter_all(self, query: Optional[Dict] = None) -> AsyncIterator[Endpoint]:
+        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/get"""
+        async for page in _paginate(self._request, f"{self._baseurl}endpoints", self._headers,
+                                    Endpoints._params(query)):
+            for point in Endpoints._convert(page):
+                yield point
+
+    def __aiter__(self) -> AsyncIterator[Endpoint]:
+        return self.iter_all()
+
+    async def fetch_all(self, query: Optional[Dict] = None) -> List[Endpoint]:
+        """Fetch all endpoints, replaces current endpoints"""
+        endpoints = [point async for point in self.iter_all(query)]
+        self._current = dict([(point.id, point) for point in endpoints])
+        return endpoints
+
+    async def _post(self, url: str) -> bool:
+        result = await self._request('post', url, headers=self._headers, json={})
+        if not result:
+            logging.error(f"Unable to post {url}: {result.status_code} {result.text}")
+            return False
+        return True
+
+    async def scan(self, e_id: str) -> bool:
+        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/%7BendpointId%7D/scans/post"""
+        return await self._post(f"{self._baseurl}endpoints/{e_id}/scans")
+
+    async def update_agent(self, e_id: str) -> bool:
+        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/%7BendpointId%7D/update-checks/post"""
+        return await self._post(f"{self._baseurl}endpoints/{e_id}/update-checks")
+
+
+class AsyncWhoamiApi(object):
+    baseurl = "https://api.central.sophos.com/whoami/v1"
+
+    def __init__(self, getter: AsyncRequest) -> None:
+        self._request = getter
+
+    async def whoami(self) -> IAm:
+        result = await self._request('get', self.baseurl)
+        if result:
+            json = result.json()
+            return IAm(json['id'], json['idType'])
+        raise Exception('''Aborting! Can't tell who I am!''')
+
+
+class AsyncPartnerApi(object):
+    """asyncio equivalent of partnerApi.PartnerApi"""
+    baseurl = "https://api.central.sophos.com/partner/v1/"
+
+    def __init__(self, getter: AsyncRequest, iam: str) -> None:
+        self.headers = {'X-Partner-ID': iam}
+        self._request = getter
+
+    def _tenant(self, ten: Dict) -> Tenant:
+        return _dict_to_tenant(ten,
+                               AsyncAlerts(self._request, f"{ten['apiHost']}/common/v1/", {'X-Tenant-ID': ten['id']}),
+                               AsyncEndpoints(self._request, f"{ten['apiHost']}/endpoint/v1/",
+                                              {'X-Tenant-ID': ten['id']}))
+
+    async def iter_tenants(self) -> AsyncIterator[Tenant]:
+        """https://developer.sophos.com/docs/partner-v1/1/routes/tenants/get
+        Page 1 reports the page total, the remaining pages are fetched concurrently.
+        Raises IncompleteListing if a page fails, rather than return some of the tenants."""
+        async for page in _paginate_pages(self._request, f"{self.baseurl}tenants", self.headers, {"pageSize": 100}):
+            for ten in page:
+                yield self._tenant(ten)
+
+    async def tenants(self) -> Dict[str, Tenant]:
+        return dict([(ten.id, ten) async for ten in self.iter_tenants()])
+
+    async def get(self, item: str) -> Tenant:
+        result = await self._request('get', f"{self.baseurl}tenants/{item}", headers=self.headers)
+        if result.status_code == 404:
+            raise KeyError(item)
+        if result:
+            return self._tenant(result.json())
+        raise Exception("Unexpected exception!")
+
+
+class AsyncApiClient(object):
+    """asyncio client. Use as an async context manager, or call close() when done.
+
+        async with AsyncApiClient(c_id, c_token) as client:
+            async for tenant in client.iter_tenants():
+                async for alert in tenant.alerts:
+                    ...
+    """
+
+    def __init__(self, c_id: str, c_token: str, limit: int = 100, limiter: Optional[RateLimiter] = None,
+                 limit_per_host: int = 32, timeout: Tuple[float, float] = (5.0, 60.0), coalesce: bool = True) -> None:
+        """
+        :param int limit: maximum simultaneous connections
+        :param RateLimiter limiter: rate limits and retry budget
+        :param int limit_per_host: maximum simultaneous connections to one api host
+        :param timeout: (connect, read) seconds
+        :param bool coalesce: identical GETs in flight at once share one request
+        """
+        if aiohttp is None:
+            raise ImportError('AsyncApiClient requires aiohttp. pip install sophosCli[async]')
+        # aiohttp binds the session to the running loop, so it is only built once there is one
+        self._session: Optional['aiohttp.ClientSession'] = None
+        self._limits = (limit, limit_per_host)
+        self._timeout = timeout
+        self._auth = AsyncAuth(c_id, c_token, session=self.session)
+        self.limiter = limiter or RateLimiter()
+        self._request = self._auth.oauth_handler(async_backoff_handler(_transport(self.session), self.limiter))
+        if coalesce:
+            self._request = async_coalesce_handler(self._request)
+        self._iam = None
+
+    def session(self) -> 'aiohttp.ClientSession':
+        """The ClientSession, created on first use. Must be called from a running event loop."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._limits[0], limit_per_host=self._limits[1],
+                                               keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self._timeout[0], sock_read=self._timeout[1]))
+        return self._session
+
+    async def whoami(self) -> IAm:
+        if self._iam is None:
+            self._iam = await AsyncWhoamiApi(self._request).whoami()
+        return self._iam
+
+    async def _partner(self) -> AsyncPartnerApi:
+        return AsyncPartnerApi(self._request, (await self.whoami()).id)
+
+    async def iter_tenants(self) -> AsyncIterator[Tenant]:
+        async for tenant in (await self._partner()).iter_tenants():
+            yield tenant
+
+    async def tenants(self) -> Dict[str, Tenant]:
+        return await (await self._partner()).tenants()
+
+    async def tenant(self, t_id: str) -> Tenant:
+        return await (await self._partner()).get(t_id)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self) -> 'AsyncApiClient':
+        self.session()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
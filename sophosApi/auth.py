@@ -1,34 +1,187 @@
+import asyncio
+import json
 import logging
-from datetime import datetime, timedelta
+import os
 from functools import wraps
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock, Timer
+from time import time
+from typing import Dict, Optional
+from weakref import WeakKeyDictionary
 
 import requests
 
+from .metrics import metrics
+
+__all__ = [
+    'Auth',
+    'TokenManager'
+]
+
+
+class TokenManager(object):
+    """Owns the oauth token for one set of credentials.
+    Refreshes ahead of expiry in the background, lets concurrent callers (threads or tasks) share a single
+    refresh and caches the token on disk so separate cli invocations can reuse it.
+    Use TokenManager.for_credentials to share one manager between clients."""
+    token_url = 'https://id.sophos.com/api/v2/oauth2/token'
+    margin = 300
+    # (connect, read) seconds for token requests
+    timeout = (5.0, 30.0)
+    _managers: Dict[str, 'TokenManager'] = {}
+    _managers_lock = Lock()
+
+    def __init__(self, c_id: str, c_token: str, cache_file: Optional[Path] = None,
+                 session: Optional[requests.Session] = None) -> None:
+        """
+        :param cache_file: where to keep the token between runs, None to disable the disk cache
+        :param session: session to request tokens with
+        """
+        self.c_id = c_id
+        self.c_token = c_token
+        self.cache_file = cache_file
+        self._session = session or requests.Session()
+        self._lock = Lock()
+        # asyncio locks belong to one event loop, so each loop refreshing gets its own
+        self._async_locks: 'WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]' = WeakKeyDictionary()
+        self._timer = None
+        self.oauth_token = None
+        self.oauth_expires = 0.0
+        self._load()
+
+    @classmethod
+    def for_credentials(cls, c_id: str, c_token: str) -> 'TokenManager':
+        """Shared manager for these credentials, disk cached in the home directory."""
+        key = sha256(f"{c_id}:{c_token}".encode()).hexdigest()
+        with cls._managers_lock:
+            if key not in cls._managers:
+                cls._managers[key] = cls(c_id, c_token, Path.home() / f".sophosCliToken-{key[:16]}")
+            return cls._managers[key]
+
+    @property
+    def fresh(self) -> bool:
+        return self.oauth_token is not None and time() < self.oauth_expires - self.margin
+
+    def token(self) -> str:
+        """Current bearer token, refreshing first if it is about to expire."""
+        if not self.fresh:
+            with self._lock:
+                if not self.fresh:
+                    self._refresh()
+        return self.oauth_token
+
+    async def token_async(self, session=None) -> str:
+        """token() for asyncio callers. Tasks of one loop share a single refresh.
+        :param aiohttp.ClientSession session: refresh through this session on the event loop. Without one the
+        blocking refresh runs in the loop's executor
+        """
+        if self.fresh:
+            return self.oauth_token
+        if session is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.token)
+        lock = self._async_locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+        async with lock:
+            if not self.fresh:
+                await self._refresh_async(session)
+        return self.oauth_token
+
+    def invalidate(self, token: Optional[str] = None) -> None:
+        """Forget the token, e.g. after a 401. Given the rejected token, only forget it if it is still current."""
+        with self._lock:
+            if token is None or token == self.oauth_token:
+                self.oauth_token = None
+                self.oauth_expires = 0.0
+
+    def _form(self) -> str:
+        return f"grant_type=client_credentials&client_id={self.c_id}&client_secret={self.c_token}&scope=token"
+
+    def _refresh(self) -> None:
+        logging.debug('Requesting new oauth token')
+        with metrics.timed('oauth_refresh'):
+            result = self._session.post(self.token_url,
+                                        headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                        timeout=self.timeout, data=self._form()).json()
+        self._accept(result)
+
+    async def _refresh_async(self, session) -> None:
+        import aiohttp
+        logging.debug('Requesting new oauth token')
+        with metrics.timed('oauth_refresh'):
+            async with session.post(self.token_url, headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                    timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0],
+                                                                  sock_read=self.timeout[1]),
+                                    data=self._form()) as response:
+                result = await response.json(content_type=None)
+        # Threads refresh under the same lock
+        with self._lock:
+            self._accept(result)
+
+    def _accept(self, result: Dict) -> None:
+        self.oauth_expires = time() + int(result['expires_in'])
+        self.oauth_token = result['access_token']
+        self._save()
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = Timer(max(0.0, self.oauth_expires - self.margin - time()), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self) -> None:
+        try:
+            with self._lock:
+                self._refresh()
+        except Exception as e:
+            # The next caller will try again in the foreground
+            logging.warning(f"Background oauth refresh failed: {e}")
+
+    def _load(self) -> None:
+        if self.cache_file is None:
+            return
+        try:
+            cached = json.loads(self.cache_file.read_text())
+            self.oauth_token, self.oauth_expires = cached['access_token'], float(cached['expires_at'])
+        except (OSError, ValueError, KeyError):
+            return
+        if self.fresh:
+            self._schedule()
+
+    def _save(self) -> None:
+        if self.cache_file is None:
+            return
+        try:
+            fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                os.chmod(self.cache_file, 0o600)
+                json.dump({'access_token': self.oauth_token, 'expires_at': self.oauth_expires}, f)
+        except OSError as e:
+            logging.warning(f"Unable to cache oauth token in {self.cache_file}: {e}")
+
 
 class Auth(object):
-    oauth_expires = datetime.fromtimestamp(0)
-    oauth_token = None
 
-    def __init__(self, c_id, c_token):
+    def __init__(self, c_id, c_token, manager: Optional[TokenManager] = None):
         self.c_id = c_id
         self.c_token = c_token
+        self.manager = manager or TokenManager.for_credentials(c_id, c_token)
 
     def oauth_handler(self, func: requests.request) -> requests.request:
-        """This should be where oauth is managed"""
+        """Adds the bearer token to every request. A 401 drops the token and retries once with a new one."""
 
         @wraps(func)
         def return_function(*args, **kwargs) -> requests.Response:
-            headers = kwargs.get('headers', dict())
-            headers.update(Authorization=f"Bearer {self.oauth_token}")
-            kwargs['headers'] = headers
-            return func(*args, **kwargs)
-
-        if datetime.now() >= self.oauth_expires:
-            logging.debug('Requesting new oauth token')
-            result = requests.post('https://id.sophos.com/api/v2/oauth2/token',
-                                   headers={'Content-Type': 'application/x-www-form-urlencoded'},
-                                   data=f"grant_type=client_credentials&client_id={self.c_id}"
-                                        f"&client_secret={self.c_token}&scope=token").json()
-            self.oauth_expires = (timedelta(seconds=int(result['expires_in'])) + datetime.now())
-            self.oauth_token = result['access_token']
+            headers = dict(kwargs.get('headers') or {})
+            for attempt in range(2):
+                token = self.manager.token()
+                headers.update(Authorization=f"Bearer {token}")
+                kwargs['headers'] = headers
+                result = func(*args, **kwargs)
+                if result.status_code != 401:
+                    break
+                self.manager.invalidate(token)
+            return result
+
         return return_function
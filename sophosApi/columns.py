@@ -0,0 +1,77 @@
+"""
+Column oriented bulk storage for endpoint and alert records.
+
+One list per field instead of one tuple per record, timestamps are kept as the api's strings and only parsed
+when read.
+"""
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+from .helpers import parse_timestamp
+
+__all__ = [
+    'Columns'
+]
+
+
+class Columns(ABC):
+    """Base for bulk record collections. Subclasses set record, _timestamps and _row."""
+    __slots__ = ('_columns', '_index')
+    record = tuple
+    # Fields holding raw timestamp strings
+    _timestamps: Tuple[str, ...] = ()
+
+    def __init__(self, items: Iterable[Dict] = ()) -> None:
+        self._columns: List[List[Any]] = [list() for _ in self.record._fields]
+        self._index: Dict[str, int] = {}
+        self.extend(items)
+
+    @staticmethod
+    @abstractmethod
+    def _row(d: Dict) -> tuple:
+        """Raw api item to a tuple of field values, timestamps left as strings."""
+        raise NotImplementedError
+
+    def extend(self, items: Iterable[Dict]) -> None:
+        """Append raw api items."""
+        columns = self._columns
+        for d in items:
+            row = self._row(d)
+            self._index[row[0]] = len(columns[0])
+            for column, value in zip(columns, row):
+                column.append(value)
+
+    def __len__(self) -> int:
+        return len(self._columns[0])
+
+    def __contains__(self, r_id: str) -> bool:
+        return r_id in self._index
+
+    def _materialize(self, i: int):
+        values = [column[i] for column in self._columns]
+        for name in self._timestamps:
+            pos = self.record._fields.index(name)
+            if values[pos] is not None:
+                values[pos] = parse_timestamp(values[pos])
+        return self.record(*values)
+
+    def __getitem__(self, key):
+        """Record by position, or by id when given a str."""
+        if isinstance(key, str):
+            return self._materialize(self._index[key])
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return self._materialize(key)
+
+    def __iter__(self) -> Iterator:
+        for i in range(len(self)):
+            yield self._materialize(i)
+
+    def column(self, name: str, raw: bool = False) -> List[Any]:
+        """All values of one field. Timestamps are parsed unless raw is set."""
+        values = self._columns[self.record._fields.index(name)]
+        if raw or name not in self._timestamps:
+            return values
+        return [None if v is None else parse_timestamp(v) for v in values]
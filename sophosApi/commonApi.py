@@ -1,33 +1,32 @@
-import logging
-from datetime import datetime
-from typing import Dict, List, NamedTuple
+import re
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import requests
-from .helpers import response_logger
+from .columns import Columns
+from .helpers import ActionResult, LruCache, bulk_dispatch, paginate, paginate_cursor, parse_timestamp, response_logger
+from .metrics import metrics
+from .records import Alert, AlertDelta
 
 __all__ = [
     'CommonApi',
-    'Alerts'
+    'Alerts',
+    'AlertColumns',
+    'AlertDelta',
+    'AlertActionReport',
+    'alert_filter'
 ]
 
-_format = "%Y-%m-%dT%H:%M:%S.%f%z"
+_severities = {'low': 0, 'medium': 1, 'high': 2}
+_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+# Fields holding lists, which only support = != and ~
+_unordered = ('allowedActions',)
+_clause = re.compile(r'^\s*(\w+)\s*(!=|>=|<=|=|~|>|<)\s*(.*?)\s*$')
 
 
-class Alert(NamedTuple):
-    id: str
-    allowedActions: List[str]
-    category: str
-    description: str
-    groupKey: str
-    managedAgent: str
-    product: str
-    raisedAt: datetime
-    severity: str
-    tenant: str
-    type: str
-
-
-def _dict_to_alert(d: Dict) -> Alert:
+def _dict_to_alert(d: Dict, parse: Callable[[str], Any] = parse_timestamp) -> Alert:
+    """:param parse: timestamp parser, pass str to keep the raw value"""
     return Alert(d['id'],
                  d.get('allowedActions', list()),
                  d.get('category'),
@@ -35,71 +34,267 @@ def _dict_to_alert(d: Dict) -> Alert:
                  d.get('groupKey'),
                  d.get('managedAgent', {}).get('id'),
                  d.get('product'),
-                 datetime.strptime(d['raisedAt'], _format),
+                 parse(d['raisedAt']),
                  d.get('severity'),
                  d.get('tenant', {}).get('id'),
                  d.get('type'))
 
 
+class AlertColumns(Columns):
+    """Bulk, column oriented alerts. raisedAt is parsed on access."""
+    __slots__ = ()
+    record = Alert
+    _timestamps = ('raisedAt',)
+    _row = staticmethod(partial(_dict_to_alert, parse=str))
+
+
+class AlertActionReport(NamedTuple):
+    action: str
+    succeeded: List[str]
+    failed: List[ActionResult]
+    skipped: List[str]
+
+
+def _compare(op: str, left, right) -> bool:
+    if op == '=':
+        return left == right
+    if op == '!=':
+        return left != right
+    if left is None:
+        return False
+    if op == '>':
+        return left > right
+    if op == '>=':
+        return left >= right
+    if op == '<':
+        return left < right
+    return left <= right
+
+
+def _clause_value(field: str, value: str) -> Any:
+    """value as the type of field, so it compares with the alert's."""
+    if field == 'severity':
+        if value.lower() not in _severities:
+            raise ValueError(f"Unknown severity {value}, choose from {list(_severities)}")
+        return value.lower()
+    if Alert.__annotations__[field] is datetime:
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f"Can't parse {field} {value!r}, use an ISO date or time such as 2021-06-01")
+        return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _clause_filter(field: str, op: str, value: str) -> Callable[[Alert], bool]:
+    if field == 'age':
+        try:
+            seconds = float(value[:-1]) * _units[value[-1]] if value[-1:] in _units else float(value)
+        except ValueError:
+            raise ValueError(f"Can't parse age {value!r}, use a number with an optional unit from {list(_units)}")
+        return lambda a: _compare(op, (datetime.now(timezone.utc) - a.raisedAt).total_seconds(), seconds)
+    if field not in Alert._fields:
+        raise ValueError(f"Unknown alert field {field}, choose from {Alert._fields + ('age',)}")
+    if op == '~':
+        value = value.lower()
+        return lambda a: value in str(getattr(a, field) or '').lower()
+    if op not in ('=', '!=') and field in _unordered:
+        raise ValueError(f"{field} can't be ordered, use = != or ~")
+    if field == 'severity':
+        if op in ('=', '!=') and '|' in value:
+            values = set([_clause_value(field, v) for v in value.split('|')])
+            return lambda a: (str(a.severity).lower() in values) == (op == '=')
+        rank = _severities[_clause_value(field, value)]
+        return lambda a: _compare(op, _severities.get(str(a.severity).lower()), rank)
+    if op in ('=', '!=') and '|' in value:
+        values = set([_clause_value(field, v) for v in value.split('|')])
+        return lambda a: (getattr(a, field) in values) == (op == '=')
+    value = _clause_value(field, value)
+    return lambda a: _compare(op, getattr(a, field), value)
+
+
+def alert_filter(expression: str) -> Callable[[Alert], bool]:
+    """Predicate from a filter expression, e.g. "severity>=medium, category=malware|pua, age>7d, type~Threat"
+    Clauses are separated by commas and must all match. Operators are = != ~ (contains) > >= < <=.
+    Alternatives for = and != are separated by |. severity orders low < medium < high, case insensitively.
+    raisedAt compares with ISO dates or times, e.g. raisedAt>=2021-06-01. age is time since raisedAt, with an
+    s, m, h, d or w unit. Raises ValueError for clauses that can't be parsed or compared."""
+    clauses = list()
+    for text in expression.split(','):
+        if not text.strip():
+            continue
+        match = _clause.match(text)
+        if match is None:
+            raise ValueError(f"Can't parse filter clause {text!r}")
+        clauses.append(_clause_filter(*match.groups()))
+    return lambda a: all(clause(a) for clause in clauses)
+
+
+def _isoformat(d: datetime) -> str:
+    """Timestamp in the format the api hands out, e.g. 2021-03-04T05:06:07.890Z"""
+    return d.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
 class Alerts:
-    _alerts = {}
+    """Current alerts, from the last full listing or sync, are kept per instance.
+    Alerts fetched one at a time are cached separately, at most cache_size of them for cache_ttl seconds."""
+    cache_size = 10000
+    cache_ttl: Optional[float] = None
 
     def __init__(self, getter, baseurl, headers) -> None:
         """"""
         self._request = getter
         self._headers = headers
         self._baseurl = baseurl
+        self._actioned = set()
+        # Unbounded, sync would report known alerts past cache_size as added every time
+        self._current: Dict[str, Alert] = {}
+        self._alerts = LruCache(self.cache_size, self.cache_ttl)
 
     def __getitem__(self, a_id: str) -> Alert:
         """https://developer.sophos.com/docs/common-v1/1/routes/alerts/%7BalertId%7D/get"""
-        if self._alerts.get(a_id) is not None:
-            return self._alerts.get(a_id)
+        if a_id in self._current:
+            return self._current[a_id]
+        cached = self._alerts.get(a_id)
+        if cached is not None:
+            return cached
         url = f"{self._baseurl}alerts/{a_id}"
         params = {}
         result = self._request('get', url, headers=self._headers, params=params)
         json = result.json()
         if result:
             alert = _dict_to_alert(json)
-            self._alerts.update({alert.id: alert})
+            self._alerts[alert.id] = alert
         else:
             raise KeyError
         return alert
 
     def __delitem__(self, key) -> None:
-        del (self._alerts[key])
+        if key not in self._current and key not in self._alerts:
+            raise KeyError(key)
+        self._current.pop(key, None)
+        self._alerts.pop(key, None)
+
+    @staticmethod
+    def _params(query=None) -> Dict:
+        params = {'pageSize': '50'}
+        if query is not None:
+            params.update(**query)
+        return params
+
+    @staticmethod
+    def _convert(page: List[Dict], columns: Optional[AlertColumns] = None) -> Optional[List[Alert]]:
+        """Alerts from a page of raw items, timed and counted. With columns, the page is added to them instead
+        and None returned."""
+        with metrics.timed('record_decode', kind='alerts'):
+            if columns is not None:
+                columns.extend(page)
+                alerts = None
+            else:
+                alerts = [_dict_to_alert(alert) for alert in page]
+        metrics.count('records', len(page), kind='alerts')
+        return alerts
+
+    def iter_all(self, query=None, pipelined: bool = False) -> Iterator[Alert]:
+        """
+        https://developer.sophos.com/docs/common-v1/1/routes/alerts/get
+        Yield all alerts page by page as they arrive. Does not touch current alerts.
+        Raises IncompleteListing if a page fails part way.
+        :param dict query: extra query parameters, e.g. from/to
+        :param bool pipelined: prefetch the next page while this one is converted"""
+        for page in paginate(self._request, f"{self._baseurl}alerts", self._headers, self._params(query), pipelined):
+            yield from self._convert(page)
+
+    def iter_pages(self, query=None, cursor: Optional[Dict] = None) -> Iterator[Tuple[List[Alert], Optional[Dict]]]:
+        """
+        https://developer.sophos.com/docs/common-v1/1/routes/alerts/get
+        Yield each page of alerts with the cursor to resume after it, None after the last page.
+        See paginate_cursor. Does not touch current alerts."""
+        for page, next_cursor in paginate_cursor(self._request, f"{self._baseurl}alerts", self._headers,
+                                                 self._params(query), cursor):
+            yield self._convert(page), next_cursor
 
-    def fetch_all(self) -> List[Alert]:
+    def fetch_columns(self, query=None, pipelined: bool = False) -> AlertColumns:
+        """
+        https://developer.sophos.com/docs/common-v1/1/routes/alerts/get
+        Fetch all alerts into compact columns. Does not touch current alerts."""
+        columns = AlertColumns()
+        for page in paginate(self._request, f"{self._baseurl}alerts", self._headers, self._params(query), pipelined):
+            self._convert(page, columns)
+        return columns
+
+    def fetch_all(self, pipelined: bool = False) -> List[Alert]:
         """
         https://developer.sophos.com/docs/common-v1/1/routes/alerts/get
         Fetch all alerts. Overwrites current alerts."""
-        """"""
-        url = f"{self._baseurl}alerts"
-        params = {'pageSize': '50'}
-        alerts = list()
-        while True:
-            result = self._request('get', url, params=params, headers=self._headers)
-            json = result.json()
-            if result:
-                alerts.extend(json['items'])
-            if result.status_code == 403:
-                logging.error(f"Denied access to alerts for {self._headers['X-Tenant-ID']}")
-                break
-            if len(json['items']) < int(params['pageSize']):
-                break
-            params['pageFromKey'] = json['pages']['nextKey']
-            params['pageSize'] = json['pages']['maxSize']
-        alerts = dict([(alert['id'], _dict_to_alert(alert)) for alert in alerts])
-        self._alerts = alerts
-        return list(self._alerts.values())
+        alerts = list(self.iter_all(pipelined=pipelined))
+        self._current = dict([(alert.id, alert) for alert in alerts])
+        return alerts
 
-    def action(self, a_id, action) -> bool:
+    def sync(self, since: Optional[datetime] = None, known: Optional[Dict[str, Alert]] = None) -> AlertDelta:
+        """Bring current alerts up to date and report what changed.
+        With since, only alerts raised at or after it are requested and merged in. Alerts actioned through
+        this instance are pruned. Without since, all alerts are fetched and anything missing is removed.
+        If a page fails, IncompleteListing is raised and current alerts are left as they were, so a partial
+        listing is never mistaken for resolved alerts.
+        :param datetime since: high-water mark returned by the previous sync
+        :param dict known: alerts from a previous run, replaces current alerts before syncing
+        """
+        current = dict(known) if known is not None else dict(self._current)
+        if since is None:
+            fresh = dict([(alert.id, alert) for alert in self.iter_all()])
+            added = [alert for a_id, alert in fresh.items() if a_id not in current]
+            removed = [a_id for a_id in current if a_id not in fresh]
+        else:
+            fresh = dict(current)
+            added = [alert for alert in self.iter_all(query={'from': _isoformat(since)})
+                     if alert.id not in current and alert.id not in self._actioned]
+            fresh.update([(alert.id, alert) for alert in added])
+            removed = [a_id for a_id in self._actioned if a_id in fresh]
+            for a_id in removed:
+                del fresh[a_id]
+        self._actioned.clear()
+        self._current = fresh
+        # Alerts resolved since the last sync still count, the watermark never moves back
+        seen = list(fresh.values()) + list(current.values())
+        watermark = max([alert.raisedAt for alert in seen] + ([since] if since else []), default=None)
+        return AlertDelta(added, removed, watermark)
+
+    def cache_stats(self) -> Dict[str, int]:
+        """LruCache.stats of the single alert cache, plus current, the alerts of the last listing or sync."""
+        return dict(self._alerts.stats(), current=len(self._current))
+
+    def _action(self, a_id: str, action: str) -> requests.Response:
         url = f"{self._baseurl}alerts/{a_id}/actions"
         result = self._request('post', url, json={'action': action, 'message': 'clear'}, headers=self._headers)
+        if result:
+            self._actioned.add(a_id)
+        return result
+
+    def action(self, a_id, action) -> bool:
+        result = self._action(a_id, action)
         if not result:
             response_logger(result)
             return False
         return True
 
+    def action_many(self, alerts: Iterable[Alert], action: str, max_workers: int = 8,
+                    dry_run: bool = False) -> AlertActionReport:
+        """Action many already loaded alerts concurrently.
+        Alerts whose allowedActions don't include action are skipped without a request.
+        :param alerts: e.g. filter(alert_filter("severity=low"), alerts.fetch_all())
+        """
+        allowed, skipped = list(), list()
+        for alert in alerts:
+            (allowed if action in alert.allowedActions else skipped).append(alert.id)
+        succeeded, failed = list(), list()
+        for result in bulk_dispatch(lambda a_id: self._action(a_id, action), allowed, max_workers, dry_run):
+            if result.ok:
+                succeeded.append(result.id)
+            else:
+                failed.append(result)
+        return AlertActionReport(action, succeeded, failed, skipped)
+
 
 class CommonApi(object):
     alerts: Alerts
@@ -0,0 +1,83 @@
+"""
+HTTP sessions per api host, with connection pools sized for the client's concurrency.
+
+Tenants live on several regional api hosts. Each host gets its own keep-alive session so a busy region can't
+starve the others of pooled connections, and every request gets a connect and read timeout.
+"""
+from threading import Lock
+from typing import Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+__all__ = [
+    'SessionPool'
+]
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class SessionPool(object):
+    """One requests.Session per scheme and host, created on first use. request() has requests.request's
+    signature, so it can stand in for Session.request under the auth and backoff wrappers."""
+
+    def __init__(self, pool_size: int = 32, timeout: Optional[Timeout] = (5.0, 60.0)) -> None:
+        """
+        :param int pool_size: connections kept open per host, match it to the requests in flight per host,
+        e.g. ApiClient.fan_out per_host times the page or bulk workers
+        :param timeout: default (connect, read) seconds for requests that don't pass their own
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = Lock()
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        # Extra connections past pool_size are opened rather than waited for, but not kept
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        # gzip and deflate always, br and zstd when their decoders are installed
+        session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+        return session
+
+    def session(self, url: str) -> requests.Session:
+        """Session for url's host."""
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = self._new_session()
+            return self._sessions[host]
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).request(method, url, **kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Per host: connections opened (each one a TLS handshake), requests sent, connections idle in the pool
+        and pool size. Many more connections than pool_size means the pool is too small for the concurrency."""
+        with self._lock:
+            sessions = list(self._sessions.items())
+        stats = {}
+        for host, session in sessions:
+            pools = session.get_adapter(host).poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                stats[host] = dict(connections=pool.num_connections, requests=pool.num_requests,
+                                   # The queue is padded with None up to the pool size
+                                   idle=sum([1 for conn in list(pool.pool.queue) if conn is not None])
+                                   if pool.pool is not None else 0,
+                                   pool_size=self.pool_size)
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
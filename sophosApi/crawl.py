@@ -0,0 +1,118 @@
+"""
+Resumable partner wide crawls.
+
+Fetching every endpoint or alert of a large partner takes long enough that a crash, a network drop or a ctrl-c
+part way through is likely. A Crawl checkpoints the tenant list, each tenant's page cursor and every page of
+records to the Store as it goes, so running the same crawl again carries on from the last page written instead
+of starting over. Finished tenants are not fetched again, unfinished ones resume from their cursor. Once every
+tenant is done the crawl is finished, and running it again starts a fresh one.
+
+    crawl = Crawl(client, Store(), 'endpoints')
+    for progress in crawl.run():
+        print(progress)
+    if crawl.finished():
+        for t_id, endpoint in crawl.results():
+            ...
+"""
+import logging
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+from .partnerApi import Tenant
+from .store import Store
+
+__all__ = [
+    'Crawl',
+    'CrawlProgress'
+]
+
+
+class CrawlProgress(NamedTuple):
+    tenant: Tenant
+    records: int  # checkpointed for the tenant so far, including earlier runs
+    done: bool
+    error: Optional[str]
+
+
+class Crawl(object):
+    """Fetch one resource of every tenant, checkpointing each page so an interrupted crawl can be resumed."""
+    resources = ('endpoints', 'alerts')
+
+    def __init__(self, client, store: Store, resource: str = 'endpoints', name: Optional[str] = None,
+                 query: Optional[Dict] = None, max_workers: int = 16, per_host: int = 4) -> None:
+        """
+        :param ApiClient client:
+        :param store: holds the checkpoint, and gets each tenant's full listing as it completes when there is no
+        query
+        :param str resource: endpoints or alerts
+        :param str name: checkpoint name, defaults to the resource. Crawls with the same name resume each other
+        :param dict query: extra query parameters for the listing. A resumed crawl keeps the query it started with
+        :param int max_workers: tenants crawled at once, see ApiClient.fan_out
+        :param int per_host: tenants crawled at once per apiHost
+        """
+        if resource not in self.resources:
+            raise ValueError(f"Can't crawl {resource}, only {', '.join(self.resources)}")
+        self.client = client
+        self.store = store
+        self.resource = resource
+        self.name = name or resource
+        self.query = query
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self._cursors: Dict[str, Optional[Dict]] = {}
+        self._records: Dict[str, int] = {}
+
+    def _start(self, restart: bool) -> None:
+        crawl = self.store.crawl(self.name)
+        if crawl is not None and crawl['resource'] != self.resource and not restart:
+            raise ValueError(f"Crawl {self.name} is of {crawl['resource']}, not {self.resource}")
+        if crawl is None or restart or crawl['finished_at'] is not None:
+            self.store.crawl_start(self.name, self.resource, self.client.tenants.values(), self.query)
+            return
+        if self.query is not None and crawl['query'] != self.query:
+            logging.warning(f"Crawl {self.name} resumes with the query it started with: {crawl['query']}")
+        self.query = crawl['query']
+
+    def _crawl_tenant(self, tenant: Tenant) -> CrawlProgress:
+        records = self._records[tenant.id]
+        pages = getattr(tenant, self.resource).iter_pages(self.query, self._cursors[tenant.id])
+        for page, cursor in pages:
+            records = self._records[tenant.id] = self.store.crawl_page(self.name, tenant.id, page, cursor)
+            if cursor is None:
+                return CrawlProgress(tenant, records, True, None)
+        error = 'page request failed'
+        self.store.crawl_failed(self.name, tenant.id, error)
+        return CrawlProgress(tenant, records, False, error)
+
+    def run(self, restart: bool = False) -> Iterator[CrawlProgress]:
+        """Crawl every tenant not done yet, yielding progress as each one finishes or fails.
+        Safe to stop at any point, run again to resume. A finished crawl starts over.
+        :param bool restart: drop the checkpoint and crawl every tenant from the start
+        """
+        self._start(restart)
+        pending = self.store.crawl_pending(self.name)
+        self._cursors = dict([(t['id'], t['cursor']) for t in pending])
+        self._records = dict([(t['id'], t['records']) for t in pending])
+        tenants = [self.client.tenant(t['id'], t['apiHost'], t['name'], on_moved=self.store.put_tenant)
+                   for t in pending]
+        for tenant, progress, error in self.client.fan_out(self._crawl_tenant, tenants, self.max_workers,
+                                                           self.per_host):
+            if error is not None:
+                self.store.crawl_failed(self.name, tenant.id, str(error))
+                progress = CrawlProgress(tenant, self._records[tenant.id], False, str(error))
+            yield progress
+
+    def status(self) -> Dict[str, int]:
+        """Tenants, tenants done, tenants whose last attempt failed and records checkpointed."""
+        return self.store.crawl_status(self.name)
+
+    def finished(self) -> bool:
+        crawl = self.store.crawl(self.name)
+        return crawl is not None and crawl['finished_at'] is not None
+
+    def results(self) -> Iterator[Tuple[str, object]]:
+        """(tenant id, Endpoint or Alert) for every record checkpointed so far."""
+        return self.store.crawl_records(self.name)
+
+    def forget(self) -> None:
+        """Drop the checkpoint and its records. The tenants' cached listings stay."""
+        self.store.forget_crawl(self.name)
@@ -1,103 +1,311 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from pprint import pformat
-from typing import Dict, List, Optional, NamedTuple
+from collections import Counter, defaultdict
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
 import logging
-from .helpers import response_logger
+from .columns import Columns
+from .helpers import (ActionResult, LruCache, bulk_dispatch, dicter, paginate, paginate_cursor, parse_timestamp,
+                      response_logger)
+from .metrics import metrics
+from .records import Endpoint
 
 import requests
 
 __all__ = [
-    "EndpointApi"
+    "EndpointApi",
+    "EndpointColumns",
+    "EndpointIndex",
+    "endpoint_query"
 ]
 
-_format = "%Y-%m-%dT%H:%M:%S.%f%z"
+# Api fields needed to fill each Endpoint field, for projection
+_api_fields = {'ipAddresses': ['ipv4Addresses', 'ipv6Addresses']}
 
 
-class Endpoint(NamedTuple):
-    id: str
-    type: str
-    tenant: str
-    hostname: str
-    health: str
-    os: str
-    ipAddresses: Optional[List[str]]
-    macAddresses: Optional[List[str]]
-    group: Optional[str]
-    tamperProtectionEnabled: bool
-    lastSeenAt: datetime
-
-
-def _dict_to_endpoint(d: Dict) -> Endpoint:
+def _dict_to_endpoint(d: Dict, parse: Callable[[str], Any] = parse_timestamp) -> Endpoint:
+    """:param parse: timestamp parser, pass str to keep the raw value"""
+    # Only id is guaranteed, the rest may have been projected away with fields
     return Endpoint(d['id'],
-                    d['type'],
-                    d['tenant']['id'],
-                    d['hostname'],
-                    d.get('health', {}).get('overall'),
-                    d['os'].get('name'),
+                    d.get('type'),
+                    dicter(d.get('tenant')).get('id'),
+                    d.get('hostname'),
+                    dicter(d.get('health')).get('overall'),
+                    dicter(d.get('os')).get('name'),
                     d.get('ipv4Addresses', []) + d.get('ipv6Addresses', []),
                     d.get('macAddresses'),
-                    d.get('group', {}).get('name'),
+                    dicter(d.get('group')).get('name'),
                     d.get('tamperProtectionEnabled'),
-                    datetime.strptime(d['lastSeenAt'], _format))
+                    parse(d['lastSeenAt']) if d.get('lastSeenAt') else None)
+
+
+def _query_value(value) -> str:
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (list, tuple, set)):
+        return ','.join(map(str, value))
+    return str(value)
+
+
+def endpoint_query(health: Union[str, Sequence[str], None] = None, type: Union[str, Sequence[str], None] = None,
+                   last_seen_before: Union[datetime, str, None] = None,
+                   last_seen_after: Union[datetime, str, None] = None, hostname: Optional[str] = None,
+                   group: Optional[str] = None, tamper_protection: Optional[bool] = None,
+                   search: Optional[str] = None, fields: Optional[Sequence[str]] = None,
+                   view: Optional[str] = None) -> Dict[str, str]:
+    """Query parameters for https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/get
+    so the api does the filtering. Everything left as None is not filtered on.
+    :param health: overall health, good, suspicious, bad or unknown, or several of them
+    :param type: computer, server or securityVm, or several of them
+    :param last_seen_before: datetime, or an ISO 8601 duration such as -P30D
+    :param last_seen_after: datetime, or an ISO 8601 duration such as -P1D
+    :param str hostname: hostname contains
+    :param str group: group name contains
+    :param bool tamper_protection: tamper protection enabled
+    :param str search: free text search
+    :param fields: Endpoint fields to return, id is always included
+    :param str view: basic, summary or full
+    """
+    query = dict([(key, _query_value(value)) for key, value in (
+        ('healthStatus', health),
+        ('type', type),
+        ('lastSeenBefore', last_seen_before),
+        ('lastSeenAfter', last_seen_after),
+        ('hostnameContains', hostname),
+        ('groupNameContains', group),
+        ('tamperProtectionEnabled', tamper_protection),
+        ('search', search),
+        ('view', view)) if value is not None])
+    if fields is not None:
+        unknown = [field for field in fields if field not in Endpoint._fields]
+        if unknown:
+            raise ValueError(f"Unknown fields {unknown}, choose from {Endpoint._fields}")
+        api_fields = ['id']
+        for field in fields:
+            api_fields.extend(f for f in _api_fields.get(field, [field]) if f not in api_fields)
+        query['fields'] = ','.join(api_fields)
+    return query
+
+
+class EndpointColumns(Columns):
+    """Bulk, column oriented endpoints. lastSeenAt is parsed on access."""
+    __slots__ = ()
+    record = Endpoint
+    _timestamps = ('lastSeenAt',)
+    _row = staticmethod(partial(_dict_to_endpoint, parse=str))
+
+
+class EndpointIndex(object):
+    """Endpoints by id, with secondary indexes for O(1) lookups and local aggregation.
+    hostname is matched case insensitively, ip against any of ipAddresses and mac against any of macAddresses."""
+    indexed = ('hostname', 'ip', 'mac', 'group', 'health', 'os', 'type')
+
+    def __init__(self, endpoints: Iterable[Endpoint] = ()) -> None:
+        self._by_id: Dict[str, Endpoint] = {}
+        self._indexes: Dict[str, Dict[Any, Set[str]]] = dict([(name, defaultdict(set)) for name in self.indexed])
+        for endpoint in endpoints:
+            self.add(endpoint)
+
+    @staticmethod
+    def _keys(endpoint: Endpoint) -> Iterator[Tuple[str, Any]]:
+        if endpoint.hostname is not None:
+            yield 'hostname', endpoint.hostname.lower()
+        for ip in endpoint.ipAddresses or ():
+            yield 'ip', ip
+        for mac in endpoint.macAddresses or ():
+            yield 'mac', mac.lower()
+        yield 'group', endpoint.group
+        yield 'health', endpoint.health
+        yield 'os', endpoint.os
+        yield 'type', endpoint.type
+
+    @staticmethod
+    def _normalize(name: str, value: Any) -> Any:
+        return value.lower() if name in ('hostname', 'mac') and isinstance(value, str) else value
+
+    def add(self, endpoint: Endpoint) -> None:
+        if endpoint.id in self._by_id:
+            self.remove(endpoint.id)
+        self._by_id[endpoint.id] = endpoint
+        for name, key in self._keys(endpoint):
+            self._indexes[name][key].add(endpoint.id)
+
+    def remove(self, e_id: str) -> None:
+        endpoint = self._by_id.pop(e_id, None)
+        if endpoint is None:
+            return
+        for name, key in self._keys(endpoint):
+            ids = self._indexes[name].get(key)
+            if ids is not None:
+                ids.discard(e_id)
+                if not ids:
+                    del self._indexes[name][key]
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, e_id: str) -> bool:
+        return e_id in self._by_id
+
+    def __getitem__(self, e_id: str) -> Endpoint:
+        return self._by_id[e_id]
+
+    def __iter__(self) -> Iterator[Endpoint]:
+        return iter(self._by_id.values())
+
+    def find(self, **criteria) -> List[Endpoint]:
+        """Endpoints matching every criterion, e.g. find(hostname='pc-01'), find(group='Servers', health='bad').
+        Criteria are the indexed names."""
+        ids = None
+        for name, value in criteria.items():
+            if name not in self._indexes:
+                raise ValueError(f"Can't find by {name}, choose from {self.indexed}")
+            matched = self._indexes[name].get(self._normalize(name, value), set())
+            ids = set(matched) if ids is None else ids & matched
+            if not ids:
+                return []
+        if ids is None:
+            return list(self._by_id.values())
+        return [self._by_id[e_id] for e_id in ids]
+
+    def count_by(self, name: str) -> Dict[Any, int]:
+        """Number of endpoints per value of an indexed name, or of any Endpoint field."""
+        if name in self._indexes:
+            return dict([(key, len(ids)) for key, ids in self._indexes[name].items()])
+        if name not in Endpoint._fields:
+            raise ValueError(f"Can't count by {name}, choose from {self.indexed + Endpoint._fields}")
+        return dict(Counter(getattr(endpoint, name) for endpoint in self._by_id.values()))
 
 
 class Endpoints:
-    _endpoints = {}
+    """Current endpoints, from the last full listing, are kept per instance and indexed for find and count_by.
+    Endpoints fetched one at a time are cached separately, at most cache_size of them for cache_ttl seconds."""
+    cache_size = 10000
+    cache_ttl: Optional[float] = None
 
     def __init__(self, getter: requests.get, baseurl, headers) -> None:
         """"""
         self._request = getter
         self._headers = headers
         self._baseurl = baseurl
+        self._index = EndpointIndex()
+        self._endpoints = LruCache(self.cache_size, self.cache_ttl)
+
+    def _replace(self, endpoints: Iterable[Endpoint]) -> None:
+        # Unbounded, a listing cut down to cache_size would give wrong find and count_by answers
+        self._index = EndpointIndex(endpoints)
 
     def __getitem__(self, e_id: str) -> Endpoint:
         """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/%7BendpointId%7D/get
         :param str e_id: endpoint id
         """
-        if self._endpoints.get(e_id) is not None:
-            return self._endpoints.get(e_id)
+        if e_id in self._index:
+            return self._index[e_id]
+        cached = self._endpoints.get(e_id)
+        if cached is not None:
+            return cached
         url = f"{self._baseurl}endpoints/{e_id}"
         endpoint = None
         result = self._request('get', url, headers=self._headers, params={"view": "summary"})
         json = result.json()
         if result:
             endpoint = _dict_to_endpoint(json)
-            self._endpoints.update({endpoint.id: endpoint})
+            self._endpoints[endpoint.id] = endpoint
         else:
             raise KeyError
-        return self._endpoints[e_id]
+        return endpoint
 
     def __delitem__(self, e_id: str) -> None:
-        del (self._endpoints[e_id])
+        if e_id not in self._index and e_id not in self._endpoints:
+            raise KeyError(e_id)
+        self._index.remove(e_id)
+        self._endpoints.pop(e_id, None)
 
-    def fetch_all(self, query=None) -> List[Endpoint]:
-        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/get
-        Fetch all endpoints, replaces current endpoints"""
+    @staticmethod
+    def _params(query=None) -> Dict:
         params = {"view": "summary", 'pageSize': '50'}
         if query is not None:
             params.update(**query)
-        url = f"{self._baseurl}endpoints"
-        endpoints = list()
-        while True:
-            result = self._request('get', url, headers=self._headers, params=params)
-            json = result.json()
-            if result:
-                endpoints.extend(json['items'])
+        return params
+
+    @staticmethod
+    def _convert(page: List[Dict], columns: Optional[EndpointColumns] = None) -> Optional[List[Endpoint]]:
+        """Endpoints from a page of raw items, timed and counted. With columns, the page is added to them instead
+        and None returned."""
+        with metrics.timed('record_decode', kind='endpoints'):
+            if columns is not None:
+                columns.extend(page)
+                points = None
             else:
-                response_logger(result)
-                break
-            if len(json['items']) < int(params['pageSize']):
-                break
-            params['pageSize'] = json['pages']['maxSize']
-            params['pageFromKey'] = json['pages']['nextKey']
-        endpoints = dict([(point['id'], _dict_to_endpoint(point)) for point in endpoints])
-        self._endpoints = endpoints
-        return list(self._endpoints.values())
+                points = [_dict_to_endpoint(point) for point in page]
+        metrics.count('records', len(page), kind='endpoints')
+        return points
+
+    def iter_all(self, query=None, pipelined: bool = False) -> Iterator[Endpoint]:
+        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/get
+        Yield all endpoints page by page as they arrive. Does not touch current endpoints.
+        :param bool pipelined: prefetch the next page while this one is converted"""
+        for page in paginate(self._request, f"{self._baseurl}endpoints", self._headers, self._params(query),
+                             pipelined):
+            yield from self._convert(page)
+
+    def iter_pages(self, query=None, cursor: Optional[Dict] = None) -> Iterator[Tuple[List[Endpoint], Optional[Dict]]]:
+        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/get
+        Yield each page of endpoints with the cursor to resume after it, None after the last page.
+        See paginate_cursor. Does not touch current endpoints."""
+        for page, next_cursor in paginate_cursor(self._request, f"{self._baseurl}endpoints", self._headers,
+                                                 self._params(query), cursor):
+            yield self._convert(page), next_cursor
+
+    def search(self, pipelined: bool = False, **filters) -> Iterator[Endpoint]:
+        """Yield endpoints matching filters, filtered by the api. See endpoint_query for the filters.
+        Does not touch current endpoints."""
+        return self.iter_all(endpoint_query(**filters), pipelined)
+
+    def fetch_columns(self, query=None, pipelined: bool = False) -> EndpointColumns:
+        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/get
+        Fetch all endpoints into compact columns. Does not touch current endpoints."""
+        columns = EndpointColumns()
+        for page in paginate(self._request, f"{self._baseurl}endpoints", self._headers, self._params(query),
+                             pipelined):
+            self._convert(page, columns)
+        return columns
+
+    def fetch_all(self, query=None, pipelined: bool = False) -> List[Endpoint]:
+        """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/get
+        Fetch all endpoints, replaces current endpoints."""
+        endpoints = list(self.iter_all(query, pipelined))
+        self._replace(endpoints)
+        return endpoints
+
+    def load(self, endpoints: Iterable[Endpoint]) -> None:
+        """Replace current endpoints without asking the api, e.g. from Store.endpoints."""
+        self._replace(endpoints)
+
+    def find(self, **criteria) -> List[Endpoint]:
+        """Current endpoints matching every criterion, no api traffic. See EndpointIndex.find."""
+        return self._index.find(**criteria)
+
+    def count_by(self, name: str) -> Dict[Any, int]:
+        """Current endpoints per value of name, no api traffic. See EndpointIndex.count_by."""
+        return self._index.count_by(name)
+
+    def cache_stats(self) -> Dict[str, int]:
+        """LruCache.stats of the single endpoint cache, plus current, the endpoints of the last full listing."""
+        return dict(self._endpoints.stats(), current=len(self._index))
+
+    def _scan(self, e_id: str) -> requests.Response:
+        return self._request('post', f"{self._baseurl}endpoints/{e_id}/scans", headers=self._headers, json={})
+
+    def _update_agent(self, e_id: str) -> requests.Response:
+        return self._request('post', f"{self._baseurl}endpoints/{e_id}/update-checks", headers=self._headers,
+                             json={})
 
     def scan(self, e_id: str) -> bool:
         """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/%7BendpointId%7D/scans/post"""
-        url = f"{self._baseurl}endpoints/{e_id}/scans"
-        result = self._request('post', url, headers=self._headers, json={})
+        result = self._scan(e_id)
         if not result:
             response_logger(result)
             return False
@@ -105,13 +313,21 @@ class Endpoints:
 
     def update_agent(self, e_id: str) -> bool:
         """https://developer.sophos.com/docs/endpoint-v1/1/routes/endpoints/%7BendpointId%7D/update-checks/post"""
-        url = f"""{self._baseurl}endpoints/{e_id}/update-checks"""
-        result = self._request('post', url, headers=self._headers, json={})
+        result = self._update_agent(e_id)
         if not result:
             response_logger(result)
             return False
         return True
 
+    def scan_many(self, e_ids: Iterable[str], max_workers: int = 8, dry_run: bool = False) -> Iterator[ActionResult]:
+        """Queue scans on many endpoints concurrently, yielding a result per endpoint as it finishes."""
+        return bulk_dispatch(self._scan, e_ids, max_workers, dry_run)
+
+    def update_many(self, e_ids: Iterable[str], max_workers: int = 8,
+                    dry_run: bool = False) -> Iterator[ActionResult]:
+        """Queue update checks on many endpoints concurrently, yielding a result per endpoint as it finishes."""
+        return bulk_dispatch(self._update_agent, e_ids, max_workers, dry_run)
+
 
 class Settings: pass
 
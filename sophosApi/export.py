@@ -0,0 +1,231 @@
+"""
+Streaming export of Endpoint and Alert records to CSV, JSON Lines or Parquet.
+
+Records are written in chunks, so only one chunk is held in memory. Parquet needs pyarrow:
+pip install sophosCli[parquet]
+"""
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+import sys
+from datetime import datetime
+from itertools import islice
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import IO, Iterable, Iterator, List, Optional, Sequence, Type, Union, get_args, get_origin
+
+__all__ = [
+    'formats',
+    'compressions',
+    'export_records',
+    'stream_tenant_records',
+    'tenant_records'
+]
+
+formats = ('csv', 'jsonl', 'parquet')
+compressions = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _chunks(records: Iterable, size: int) -> Iterator[List]:
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _open_text(output: Union[str, IO], compression: Optional[str]) -> IO:
+    if output == '-':
+        if compression is None:
+            return sys.stdout
+        output = sys.stdout.buffer
+    if isinstance(output, str):
+        if compression is None:
+            return open(output, 'w', newline='', encoding='utf-8')
+        return compressions[compression](output, 'wt', newline='', encoding='utf-8')
+    if compression is None:
+        return output
+    if compression == 'gzip':
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=output, mode='wb'), encoding='utf-8', newline='')
+    raise ValueError(f"Only gzip compression can be written to a stream, not {compression}")
+
+
+def _write_csv(chunks: Iterator[List], fields: Sequence[str], f: IO) -> None:
+    writer = csv.writer(f)
+    if fields:
+        writer.writerow(fields)
+    for chunk in chunks:
+        writer.writerows([[';'.join(map(str, v)) if isinstance(v, list) else _value(v)
+                           for v in (getattr(r, field) for field in fields)] for r in chunk])
+
+
+def _write_jsonl(chunks: Iterator[List], fields: Sequence[str], f: IO) -> None:
+    for chunk in chunks:
+        f.write(''.join([json.dumps(dict([(field, _value(getattr(r, field))) for field in fields])) + '\n'
+                         for r in chunk]))
+
+
+def _arrow_type(pa, annotation):
+    args = [a for a in get_args(annotation) if a is not type(None)]
+    if get_origin(annotation) is Union and len(args) == 1:
+        annotation = args[0]
+    if get_origin(annotation) is list:
+        return pa.list_(pa.string())
+    if annotation is bool:
+        return pa.bool_()
+    if annotation is datetime:
+        return pa.timestamp('us', tz='UTC')
+    return pa.string()
+
+
+def _write_parquet(chunks: Iterator[List], fields: Sequence[str], record: Optional[Type],
+                   output: Union[str, IO], compression: Optional[str]) -> None:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Parquet export requires pyarrow. pip install sophosCli[parquet]')
+    annotations = record.__annotations__ if record is not None else {}
+    schema = pa.schema([(field, _arrow_type(pa, annotations.get(field, str))) for field in fields])
+    # Written even with no chunks, an empty export still has its schema
+    writer = pq.ParquetWriter(sys.stdout.buffer if output == '-' else output, schema,
+                              compression=compression or 'snappy')
+    try:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pydict(
+                dict([(field, [getattr(r, field) for r in chunk]) for field in fields]), schema=writer.schema))
+    finally:
+        writer.close()
+
+
+def export_records(records: Iterable, output: Union[str, IO] = '-', fmt: str = 'csv',
+                   fields: Optional[Sequence[str]] = None, compression: Optional[str] = None,
+                   chunk_size: int = 5000, record: Optional[Type] = None) -> int:
+    """Write Endpoint or Alert records to a file, a stream or stdout.
+    The output is written even when there are no records: a csv header, or a parquet file with the schema.
+    :param records: any iterable of records, e.g. Endpoints.iter_all() or stream_tenant_records(...)
+    :param output: path, binary stream for gzip or parquet, text stream otherwise, or '-' for stdout
+    :param str fmt: one of formats
+    :param fields: record fields to write, defaults to all of them
+    :param str compression: gzip, bz2 or xz for csv and jsonl, any pyarrow codec for parquet
+    :param int chunk_size: records held in memory at once
+    :param record: Endpoint or Alert, gives the fields and types when there are no records to learn them from
+    :return: number of records written
+    """
+    if fmt not in formats:
+        raise ValueError(f"Unknown format {fmt}, choose from {formats}")
+    if compression is not None and fmt != 'parquet' and compression not in compressions:
+        raise ValueError(f"Unknown compression {compression}, choose from {list(compressions)}")
+    count = 0
+
+    def counted(chunks: Iterator[List]) -> Iterator[List]:
+        nonlocal count
+        for chunk in chunks:
+            count += len(chunk)
+            yield chunk
+
+    chunks = counted(_chunks(records, chunk_size))
+    first = next(chunks, None)
+    if first is not None:
+        record = type(first[0])
+    if fields is None:
+        fields = record._fields if record is not None else ()
+    if record is not None:
+        unknown = [field for field in fields if field not in record._fields]
+        if unknown:
+            raise ValueError(f"Unknown fields {unknown}, choose from {record._fields}")
+
+    def all_chunks() -> Iterator[List]:
+        if first is not None:
+            yield first
+            yield from chunks
+
+    if fmt == 'parquet':
+        _write_parquet(all_chunks(), fields, record, output, compression)
+        return count
+    f = _open_text(output, compression)
+    try:
+        if fmt == 'csv':
+            _write_csv(all_chunks(), fields, f)
+        else:
+            _write_jsonl(all_chunks(), fields, f)
+    finally:
+        if f is sys.stdout:
+            f.flush()
+        elif f is not output:
+            f.close()
+    return count
+
+
+def tenant_records(results: Iterable) -> Iterator:
+    """Flatten TenantResults from ApiClient.fan_out into their records, skipping failed tenants."""
+    for tenant, records, error in results:
+        if error is None:
+            yield from records
+
+
+def stream_tenant_records(client, resource: str, max_workers: int = 4, per_host: int = 2,
+                          buffer: int = 16) -> Iterator:
+    """Records of every tenant as their pages arrive, for partner wide exports too large to hold in memory.
+    Tenants are fetched max_workers at a time and workers wait while buffer pages are queued, so at most about
+    max_workers + buffer pages are held at once. Pages are interleaved across tenants. A tenant failing part way
+    is logged by fan_out and its remaining pages are missing from the output.
+    :param ApiClient client:
+    :param str resource: endpoints or alerts
+    :param int max_workers: tenants fetched at once, see ApiClient.fan_out
+    :param int per_host: tenants fetched at once per apiHost
+    :param int buffer: pages queued for the writer before workers wait
+    """
+    pages = Queue(buffer)
+    stopped = Event()
+    done = object()
+
+    def put(item) -> None:
+        while not stopped.is_set():
+            try:
+                return pages.put(item, timeout=0.1)
+            except Full:
+                continue
+
+    def fetch(tenant) -> None:
+        from .helpers import IncompleteListing
+        for page, cursor in getattr(tenant, resource).iter_pages():
+            if stopped.is_set():
+                return
+            put(page)
+            if cursor is None:
+                return
+        raise IncompleteListing(f"{resource} of {tenant.id}")
+
+    def run() -> None:
+        try:
+            for _ in client.fan_out(fetch, max_workers=max_workers, per_host=per_host):
+                pass
+        finally:
+            put(done)
+
+    Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            page = pages.get()
+            if page is done:
+                return
+            yield from page
+    finally:
+        # The writer gave up, let the workers stop instead of waiting on a full queue
+        stopped.set()
+        while True:
+            try:
+                pages.get_nowait()
+            except Empty:
+                break
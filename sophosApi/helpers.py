@@ -1,17 +1,37 @@
 import logging
-from functools import wraps
+import re
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
 from pprint import pformat
-from random import randint
-from time import sleep
-from typing import Dict, Optional
+from random import random
+from sys import getsizeof
+from threading import RLock
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import requests
 
+from .metrics import metrics, route
+from .rateLimit import RateLimiter
 
 __all__ = [
     'dicter',
+    'LruCache',
+    'parse_timestamp',
     'response_logger',
-    'backoff_handler'
+    'redact_headers',
+    'log_exchange',
+    'http_logger',
+    'backoff_handler',
+    'coalesce_handler',
+    'ActionResult',
+    'bulk_dispatch',
+    'IncompleteListing',
+    'paginate',
+    'paginate_cursor',
+    'paginate_pages'
 ]
 
 
@@ -22,73 +42,494 @@ def dicter(d: Optional[Dict]) -> Dict:
     return {}
 
 
-def response_logger(response: requests.Response) -> None:
-    response.request.headers.update({'Authorization': "REDACTED"})
-    logging.error(f"""Unable to update agent: {pformat({
+def _sizeof(value) -> int:
+    """Rough bytes held by a record: the tuple, its fields and the items of list fields."""
+    size = getsizeof(value)
+    if isinstance(value, tuple):
+        for field in value:
+            size += getsizeof(field)
+            if isinstance(field, list):
+                size += sum(map(getsizeof, field))
+    return size
+
+
+class LruCache(object):
+    """Thread safe mapping bounded to maxsize entries, evicting the least recently used.
+    Entries older than ttl seconds are dropped when next touched, or by expire().
+    Keeps approximate memory use and hit/miss/eviction counts, see stats()."""
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[Any, Any], None]] = None) -> None:
+        """
+        :param int maxsize: entries kept
+        :param float ttl: seconds an entry stays valid, None to keep until evicted
+        :param on_evict: called with key and value whenever an entry is evicted, expires or is deleted
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: OrderedDict = OrderedDict()
+        self._lock = RLock()
+        self._bytes = 0
+        self._counts = defaultdict(int)
+
+    def _drop(self, key, reason: str):
+        stamp, value, size = self._data.pop(key)
+        self._bytes -= size
+        self._counts[reason] += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+        return value
+
+    def _live(self, key) -> bool:
+        entry = self._data.get(key)
+        if entry is None:
+            return False
+        if self.ttl is not None and monotonic() - entry[0] > self.ttl:
+            self._drop(key, 'expirations')
+            return False
+        return True
+
+    def get(self, key, default=None):
+        with self._lock:
+            if not self._live(key):
+                self._counts['misses'] += 1
+                return default
+            self._counts['hits'] += 1
+            self._data.move_to_end(key)
+            return self._data[key][1]
+
+    def __getitem__(self, key):
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        with self._lock:
+            if key in self._data:
+                self._drop(key, 'replaced')
+            size = _sizeof(value)
+            self._data[key] = (monotonic(), value, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)), 'evictions')
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            self._drop(key, 'deletions')
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._drop(key, 'deletions')
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return self._live(key)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def update(self, items) -> None:
+        for key, value in (items.items() if hasattr(items, 'items') else items):
+            self[key] = value
+
+    def expire(self) -> None:
+        """Drop every entry older than ttl now instead of when it is next touched."""
+        if self.ttl is None:
+            return
+        with self._lock:
+            for key in [key for key, entry in self._data.items() if monotonic() - entry[0] > self.ttl]:
+                self._drop(key, 'expirations')
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        self.expire()
+        with self._lock:
+            return [(key, entry[1]) for key, entry in self._data.items()]
+
+    def values(self) -> List[Any]:
+        return [value for key, value in self.items()]
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._data):
+                self._drop(key, 'deletions')
+
+    def stats(self) -> Dict[str, int]:
+        """entries, maxsize, approx_bytes, hits, misses, evictions, expirations, replaced and deletions"""
+        with self._lock:
+            return dict(self._counts, entries=len(self._data), maxsize=self.maxsize, approx_bytes=self._bytes)
+
+
+_format = "%Y-%m-%dT%H:%M:%S.%f%z"
+
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(s: str) -> datetime:
+    """Parse the api's timestamps, e.g. 2021-03-04T05:06:07.890Z, much faster than strptime.
+    Anything not in that shape falls back to strptime."""
+    if len(s) >= 20 and s[-1] == 'Z' and s[10] == 'T':
+        micro = 0
+        if s[19] == '.':
+            micro = int((s[20:-1] + '000000')[:6])
+        return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                        micro, timezone.utc)
+    return datetime.strptime(s, _format)
+
+
+http_logger = logging.getLogger('sophosApi.http')
+# Bodies are cut to this many characters, and only attached for this fraction of requests
+http_body_limit = 2048
+http_body_sample = 1.0
+_redacted_headers = {'authorization', 'cookie', 'set-cookie', 'x-api-key'}
+_redacted_body = re.compile(r'(client_secret=|"access_token"\s*:\s*")[^&"]*')
+
+
+def redact_headers(headers) -> Dict:
+    """Copy of headers with secrets replaced. Never touches the live request."""
+    return dict([(k, 'REDACTED' if k.lower() in _redacted_headers else v) for k, v in (headers or {}).items()])
+
+
+def _body(body) -> Optional[str]:
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    body = _redacted_body.sub(r'\1REDACTED', str(body))
+    if len(body) > http_body_limit:
+        return f"{body[:http_body_limit]}... [{len(body) - http_body_limit} more characters]"
+    return body
+
+
+class _Lazy(object):
+    """Formats the exchange only if a handler actually emits the record."""
+
+    def __init__(self, payload: Callable[[], Dict]) -> None:
+        self.payload = payload
+
+    def __str__(self) -> str:
+        return pformat(self.payload(), depth=3)
+
+
+def exchange(method: str, url: str, request_headers, response, request_body=None, bodies: bool = True,
+             **timing) -> Dict:
+    """Structured, redacted description of one request and its response.
+    :param response: requests.Response, or anything with status_code, headers, url and text
+    :param timing: extra fields, e.g. elapsed_ms, attempt, wait_ms
+    """
+    payload = dict(timing)
+    payload.update({
         "request": {
-            "headers": response.request.headers,
-            "method": response.request.method,
-            "url": response.request.url,
-            "body": getattr(response.request, "body", None)
+            "headers": redact_headers(request_headers),
+            "method": method,
+            "url": url,
         },
         "response": {
-            "headers": response.headers,
+            "headers": dict(response.headers),
             "url": response.url,
-            "body": response.text,
             "status_code": response.status_code
-        }})}""")
+        }})
+    if bodies:
+        payload['request']['body'] = _body(request_body)
+        payload['response']['body'] = _body(response.text)
+    return payload
+
+
+def log_exchange(method: str, url: str, request_headers, response, request_body=None,
+                 level: int = logging.DEBUG, **timing) -> None:
+    """Log a request and its response on the sophosApi.http logger.
+    Nothing is built unless the level is enabled. Timing fields are also attached to the record as
+    record.http for handlers doing their own analysis."""
+    if not http_logger.isEnabledFor(level):
+        return
+    bodies = http_body_sample >= 1.0 or random() < http_body_sample
+    http_logger.log(level, "%s %s -> %s in %.1fms\n%s", method, url, response.status_code,
+                    timing.get('elapsed_ms', 0.0),
+                    _Lazy(lambda: exchange(method, url, request_headers, response, request_body, bodies, **timing)),
+                    extra={'http': dict(timing, method=method, url=url, status_code=response.status_code)})
+
+
+def response_logger(response: requests.Response) -> None:
+    log_exchange(response.request.method, response.request.url, response.request.headers, response,
+                 getattr(response.request, "body", None), level=logging.ERROR)
 
 
-def backoff_handler(func: requests.request):
-    """Where backoffs and retries happen
-    Important that the requests are not cached!"""
+def backoff_handler(func: requests.request, limiter: Optional[RateLimiter] = None):
+    """Where rate limiting, backoffs and retries happen
+    Every request takes a token from its host and tenant bucket first. 429s, 5xxs and connection errors are
+    retried after the server's Retry-After, or a randomized exponential backoff, until the limiter's retry
+    budget or deadline runs out. Important that the requests are not cached!
+    :param RateLimiter limiter: shared between every request of a client, a private one by default"""
+    if limiter is None:
+        limiter = RateLimiter()
 
-    def exception_handler(*args, **kwargs):
-        success = False
-        while not success:
+    @wraps(func)
+    def return_function(method, url, *args, **kwargs) -> requests.Response:
+        key = limiter.key(url, kwargs.get('headers'))
+        started = monotonic()
+        attempt = 0
+        while True:
+            wait = limiter.reserve(key)
+            if wait > 0:
+                metrics.count('throttle_seconds', wait)
+                sleep(wait)
+            attempt += 1
+            sent = monotonic()
             try:
-                result = func(*args, **kwargs)
-                success = True
-            except TimeoutError:
-                logging.error('Request timed out.')
-            except requests.exceptions.ConnectionError as e:
+                return_result = func(method, url, *args, **kwargs)
+            except (TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.request(method.upper(), url, None, monotonic() - sent)
                 logging.error(f'Connection exception happened. {e}')
-            except Exception as e:
-                logging.error(f"Unknown connection error {e}")
-        return result
+                delay = limiter.exception_delay(attempt)
+                if not limiter.allow_retry(attempt, started, delay):
+                    raise
+                metrics.count('retries', reason=type(e).__name__)
+                metrics.count('backoff_seconds', delay)
+                sleep(delay)
+                continue
+            elapsed = monotonic() - sent
+            request = return_result.request
+            body = getattr(request, "body", None)
+            decoded = len(return_result.content)
+            metrics.request(request.method, request.url, return_result.status_code, elapsed,
+                            int(return_result.headers.get('Content-Length') or decoded), decoded,
+                            len(body) if body else 0)
+            log_exchange(request.method, request.url, request.headers, return_result, body,
+                         elapsed_ms=elapsed * 1000, wait_ms=wait * 1000, attempt=attempt)
+            delay = limiter.retry_delay(key, return_result.status_code, return_result.headers, attempt)
+            if delay is None:
+                return return_result
+            if return_result.status_code > 499:
+                response_logger(return_result)
+            if not limiter.allow_retry(attempt, started, delay):
+                return return_result
+            limiter.hold(key, return_result.headers, delay)
+            metrics.count('retries', reason=str(return_result.status_code))
+            metrics.count('backoff_seconds', delay)
+            logging.warning(f"Backing off for {int(delay * 1000)}ms")
+            sleep(delay)
+
+    return return_function
+
+
+def _coalesce_key(method: str, url: str, kwargs: Dict) -> Optional[Tuple]:
+    """Identity of an idempotent GET, None for anything that must not be shared."""
+    if method.upper() != 'GET' or set(kwargs) - {'params', 'headers'}:
+        return None
+    params = kwargs.get('params') or {}
+    headers = kwargs.get('headers') or {}
+    # Authorization is left out, the token may be refreshed between two otherwise identical requests
+    return (url, tuple(sorted([(k, str(v)) for k, v in params.items()])),
+            tuple(sorted([(k, str(v)) for k, v in headers.items() if k.lower() != 'authorization'])))
+
+
+def _shared_json(response):
+    """Parse the body once for every caller sharing response. The parsed body must be treated as read only."""
+    parse = response.json
+    parsed = []
+
+    def json(**kwargs):
+        if kwargs:
+            return parse(**kwargs)
+        if not parsed:
+            parsed.append(parse())
+        return parsed[0]
+
+    response.json = json
+    return response
+
+
+def coalesce_handler(func: requests.request) -> requests.request:
+    """Identical GETs in flight at the same time share one call, including its auth and retries, and one parsed
+    body. Waiters get the caller's response or exception. Nothing is cached, the next identical GET after the
+    call finishes goes to the network again."""
+    in_flight: Dict[Tuple, List] = {}
+    lock = RLock()
 
     @wraps(func)
-    def return_function(*args, **kwargs) -> requests.Response:
-        count = 1
-        while True:
-            return_result = exception_handler(*args, **kwargs)
-            logging.debug(pformat({
-                "request": {
-                    "headers": return_result.request.headers,
-                    "method": return_result.request.method,
-                    "url": return_result.request.url,
-                    "data": getattr(return_result.request, "data", None)
-                },
-                "response": {
-                    "headers": return_result.headers,
-                    "url": return_result.url,
-                    "body": return_result.text,
-                    "status_code": return_result.status_code
-
-                }}, depth=3))
-            if return_result.status_code == 429 or str(return_result.status_code).startswith('5'):
-                if return_result.status_code > 499:
-                    response_logger(return_result)
-                count = count + 1
-                backoff = randint(0, min(30000, (1000 * (2 ** count))))
-                logging.warning(f"Backing off for {backoff}ms")
-                if 10 > count > 5:
-                    logging.warning(f"This is the {count} retry.")
-                if count > 10:
-                    logging.error(f"This is the {count} retry.")
-                sleep(backoff / 1000)
+    def return_function(method, url, *args, **kwargs) -> requests.Response:
+        key = None if args else _coalesce_key(method, url, kwargs)
+        if key is None:
+            return func(method, url, *args, **kwargs)
+        with lock:
+            entry = in_flight.get(key)
+            if entry is None:
+                # [future result, number of waiters]
+                entry = in_flight[key] = [Future(), 0]
+                leader = True
             else:
-                break
-        return return_result
+                entry[1] += 1
+                leader = False
+        if not leader:
+            metrics.count('coalesced', route=route(url))
+            return entry[0].result()
+        try:
+            result = func(method, url, **kwargs)
+        except BaseException as e:
+            with lock:
+                del in_flight[key]
+            entry[0].set_exception(e)
+            raise
+        with lock:
+            del in_flight[key]
+            shared = entry[1] > 0
+        if shared:
+            _shared_json(result)
+        entry[0].set_result(result)
+        return result
 
     return return_function
+
+
+class ActionResult(NamedTuple):
+    id: str
+    ok: bool
+    error: Optional[str]  # why it failed, None otherwise
+    status: str  # accepted, dry run or failed
+
+
+def bulk_dispatch(func: Callable[[str], requests.Response], ids: Iterable[str], max_workers: int = 8,
+                  dry_run: bool = False) -> Iterator[ActionResult]:
+    """Call func for every id on a bounded thread pool, yielding an ActionResult as each one finishes.
+    Failures, including exceptions, are reported on the result instead of stopping the run.
+    :param func: sends the request for one id and returns the response
+    :param bool dry_run: report what would be done without sending anything
+    """
+    ids = list(dict.fromkeys(ids))
+    if dry_run:
+        for r_id in ids:
+            yield ActionResult(r_id, True, None, 'dry run')
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict([(executor.submit(func, r_id), r_id) for r_id in ids])
+        for future in as_completed(futures):
+            r_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                yield ActionResult(r_id, False, str(e), 'failed')
+                continue
+            if result:
+                yield ActionResult(r_id, True, None, 'accepted')
+            else:
+                yield ActionResult(r_id, False, f"{result.status_code} {result.text[:200]}", 'failed')
+
+
+class IncompleteListing(Exception):
+    """A page of a listing failed, so the records already yielded are not the whole collection."""
+
+
+def _page_failed(result: requests.Response, url: str, headers: Dict) -> None:
+    if result.status_code == 403:
+        logging.error(f"Denied access to {url} for {headers}")
+    else:
+        response_logger(result)
+
+
+def _page_json(result: requests.Response, url: str) -> Dict:
+    path = route(url)
+    with metrics.timed('json_decode', route=path):
+        json = result.json()
+    metrics.count('pages', route=path)
+    return json
+
+
+def paginate(request: requests.request, url: str, headers: Dict, params: Dict,
+             pipelined: bool = False) -> Iterator[List[Dict]]:
+    """Yield the raw items of each page of a pageFromKey (cursor) paginated route.
+    Raises IncompleteListing at the first failed page, after yielding the pages before it.
+    :param request: requests getter with all appropriate wrappers
+    :param dict params: initial query, must contain pageSize
+    :param bool pipelined: request the next page in the background as soon as its nextKey is known, so the
+        transfer overlaps with the caller converting the current page
+    """
+    params = dict(params)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        upcoming = None
+        while True:
+            if upcoming is None:
+                result = request('get', url, headers=headers, params=dict(params))
+            else:
+                result = upcoming.result()
+                upcoming = None
+            if not result:
+                _page_failed(result, url, headers)
+                raise IncompleteListing(f"{result.status_code} fetching {url}")
+            json = _page_json(result, url)
+            last = len(json['items']) < int(params['pageSize'])
+            if not last:
+                params['pageFromKey'] = json['pages']['nextKey']
+                params['pageSize'] = json['pages']['maxSize']
+                if pipelined:
+                    upcoming = executor.submit(request, 'get', url, headers=headers, params=dict(params))
+            yield json['items']
+            if last:
+                return
+
+
+def paginate_cursor(request: requests.request, url: str, headers: Dict, params: Dict,
+                    cursor: Optional[Dict] = None) -> Iterator[Tuple[List[Dict], Optional[Dict]]]:
+    """Yield the raw items of each page of a pageFromKey route, with the cursor for the page after it.
+    The cursor is None after the last page. Stops at the first failed page, so a caller that never saw a None
+    cursor knows the listing is incomplete and can resume from the last cursor it saw.
+    :param dict params: initial query, must contain pageSize
+    :param dict cursor: from an earlier page, to resume after it
+    """
+    params = dict(params, **(cursor or {}))
+    while True:
+        result = request('get', url, headers=headers, params=dict(params))
+        if not result:
+            _page_failed(result, url, headers)
+            return
+        json = _page_json(result, url)
+        next_key = json['pages'].get('nextKey')
+        if len(json['items']) < int(params['pageSize']) or not next_key:
+            yield json['items'], None
+            return
+        params['pageFromKey'] = next_key
+        params['pageSize'] = json['pages']['maxSize']
+        yield json['items'], {'pageFromKey': next_key, 'pageSize': params['pageSize']}
+
+
+def paginate_pages(request: requests.request, url: str, headers: Dict, params: Dict,
+                   max_workers: int = 8) -> Iterator[List[Dict]]:
+    """Yield the raw items of each page of a page number paginated route, in page order.
+    Page 1 is requested with pageTotal, then every remaining page is fetched in parallel. Without a page total,
+    pages are fetched one after another until a short page. Raises IncompleteListing at the first failed page.
+    :param dict params: initial query, must contain pageSize
+    :param int max_workers: concurrent page requests after the first
+    """
+    params = dict(params, page=1)
+    result = request('get', url, headers=headers, params=dict(params, pageTotal='true'))
+    if not result:
+        _page_failed(result, url, headers)
+        raise IncompleteListing(f"{result.status_code} fetching {url}")
+    json = _page_json(result, url)
+    yield json['items']
+    if 'total' not in json['pages']:
+        while len(json['items']) >= int(params['pageSize']):
+            params['page'] += 1
+            params['pageSize'] = json['pages'].get('maxSize', params['pageSize'])
+            result = request('get', url, headers=headers, params=dict(params))
+            if not result:
+                _page_failed(result, url, headers)
+                raise IncompleteListing(f"{result.status_code} fetching {url}")
+            json = _page_json(result, url)
+            yield json['items']
+        return
+    total = int(json['pages']['total'])
+    if total < 2:
+        return
+
+    def fetch(page: int) -> requests.Response:
+        return request('get', url, headers=headers, params=dict(params, page=page))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(fetch, range(2, total + 1)):
+            if not result:
+                _page_failed(result, url, headers)
+                raise IncompleteListing(f"{result.status_code} fetching {url}")
+            yield _page_json(result, url)['items']
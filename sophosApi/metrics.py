@@ -0,0 +1,239 @@
+"""
+In process metrics for the request pipeline.
+
+backoff_handler records every attempt's latency per route, bytes on the wire and decoded, retries and time
+spent backing off or throttled. Pagination records pages and json decode time, record conversion its own time,
+and TokenManager each oauth refresh. Everything lands in the module level metrics registry:
+
+    from sophosApi.metrics import metrics
+    metrics.add_hook(lambda name, value, labels: ...)   # see every observation as it happens
+    print(metrics.summary())                            # or to_prometheus(), to_json()
+"""
+import json
+import re
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+__all__ = [
+    'Histogram',
+    'Metrics',
+    'metrics',
+    'route'
+]
+
+# Upper bounds in seconds, the same as Prometheus client defaults plus 30s for slow pages
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+Hook = Callable[[str, float, Dict[str, str]], None]
+
+_id = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F-]+$|^[0-9a-fA-F]{16,}$')
+
+
+def route(url: str) -> str:
+    """Path of url with ids replaced by {id}, so every endpoint or alert shares one route."""
+    return '/'.join(['{id}' if _id.match(segment) else segment for segment in urlsplit(url).path.split('/')])
+
+
+class Histogram(object):
+    """Counts per bucket, plus sum and count."""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate, interpolated within the bucket holding the q-th observation."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = buckets[i - 1] if i > 0 else 0.0
+                upper = buckets[i] if i < len(buckets) else buckets[-1] * 2
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return buckets[-1]
+
+
+def _key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted([(k, str(v)) for k, v in labels.items()]))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    """Thread safe counters and latency histograms keyed by name and labels."""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._hooks: List[Hook] = []
+
+    def add_hook(self, hook: Hook) -> None:
+        """Call hook(name, value, labels) for every count and observation, e.g. to forward to statsd."""
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: Hook) -> None:
+        self._hooks.remove(hook)
+
+    def _notify(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        for hook in list(self._hooks):
+            hook(name, value, labels)
+
+    def count(self, name: str, amount: float = 1.0, **labels) -> None:
+        with self._lock:
+            self._counters[(name, _key(labels))] += amount
+        if self._hooks:
+            self._notify(name, amount, labels)
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, _key(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(seconds)
+        if self._hooks:
+            self._notify(name, seconds, labels)
+
+    @contextmanager
+    def timed(self, name: str, **labels) -> Iterator[None]:
+        """Observe how long the block takes in the name histogram."""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    def request(self, method: str, url: str, status: Optional[int], seconds: float, received: int = 0,
+                decoded: int = 0, sent: int = 0) -> None:
+        """One http attempt. status is None when it failed without a response.
+        :param int received: bytes on the wire, decoded: bytes after content decoding"""
+        path = route(url)
+        self.observe('request_seconds', seconds, method=method, route=path)
+        self.count('requests', method=method, route=path, status=status if status is not None else 'error')
+        if received:
+            self.count('received_bytes', received, route=path)
+        if decoded:
+            self.count('decoded_bytes', decoded, route=path)
+        if sent:
+            self.count('sent_bytes', sent, route=path)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def counter(self, name: str, **labels) -> float:
+        """Value of a counter, summed over every label set that includes labels."""
+        wanted = set(_key(labels))
+        with self._lock:
+            return sum([v for (n, key), v in self._counters.items() if n == name and wanted <= set(key)])
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        """Histogram of name merged over every label set that includes labels."""
+        wanted = set(_key(labels))
+        merged = Histogram()
+        with self._lock:
+            for (n, key), h in self._histograms.items():
+                if n == name and wanted <= set(key):
+                    merged.counts = [a + b for a, b in zip(merged.counts, h.counts)]
+                    merged.sum += h.sum
+                    merged.count += h.count
+        return merged
+
+    def as_dict(self) -> Dict[str, List[Dict]]:
+        with self._lock:
+            return {'counters': [{'name': name, 'labels': dict(key), 'value': value}
+                                 for (name, key), value in sorted(self._counters.items())],
+                    'histograms': [{'name': name, 'labels': dict(key), 'count': h.count, 'sum': h.sum,
+                                    'buckets': dict(zip([f"{b:g}" for b in buckets] + ['+Inf'], h.counts))}
+                                   for (name, key), h in sorted(self._histograms.items())]}
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self, prefix: str = 'sophoscli') -> str:
+        """Prometheus text exposition format."""
+        def labelled(key: Labels, extra: Labels = ()) -> str:
+            pairs = key + extra
+            return '{' + ','.join([f'{k}="{_escape(v)}"' for k, v in pairs]) + '}' if pairs else ''
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted([(k, (list(h.counts), h.sum, h.count)) for k, h in self._histograms.items()])
+        typed = set()
+        for (name, key), value in counters:
+            metric = f"{prefix}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{labelled(key)} {value:g}")
+        for (name, key), (counts, total, count) in histograms:
+            metric = f"{prefix}_{name}"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket in zip([f"{b:g}" for b in buckets] + ['+Inf'], counts):
+                cumulative += bucket
+                lines.append(f"{metric}_bucket{labelled(key, (('le', bound),))} {cumulative}")
+            lines.append(f"{metric}_sum{labelled(key)} {total:g}")
+            lines.append(f"{metric}_count{labelled(key)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Where the time went, per route and per pipeline stage, for people."""
+        with self._lock:
+            routes = sorted(set([dict(key).get('method', '') + ' ' + dict(key).get('route', '')
+                                 for (name, key) in self._histograms if name == 'request_seconds']))
+        val = f"{'Route'.ljust(44)}\tCalls\tErrors\tp50 ms\tp95 ms\tTotal s\tKiB in\n"
+        for method_route in routes:
+            method, path = method_route.split(' ', 1)
+            h = self.histogram('request_seconds', method=method, route=path)
+            with self._lock:
+                errors = sum([v for (n, key), v in self._counters.items() if n == 'requests'
+                              and dict(key)['method'] == method and dict(key)['route'] == path
+                              and not dict(key)['status'].startswith('2')])
+            val = val + (f"{method_route[:44].ljust(44)}\t{h.count}\t{errors:g}\t{h.quantile(0.5) * 1000:.0f}\t"
+                         f"{h.quantile(0.95) * 1000:.0f}\t{h.sum:.2f}\t"
+                         f"{self.counter('received_bytes', route=path) / 1024:.0f}\n")
+        stages = [('oauth_refresh', 'Oauth refreshes'), ('json_decode', 'Json decode'),
+                  ('record_decode', 'Record conversion')]
+        for name, label in stages:
+            h = self.histogram(name)
+            if h.count:
+                val = val + f"{label}: {h.count} in {h.sum:.2f}s\n"
+        pages = self.counter('pages')
+        if pages:
+            val = val + f"Pages: {pages:g}, records: {self.counter('records'):g}\n"
+        retries = self.counter('retries')
+        if retries:
+            val = val + f"Retries: {retries:g}, backing off {self.counter('backoff_seconds'):.2f}s\n"
+        throttled = self.counter('throttle_seconds')
+        if throttled:
+            val = val + f"Throttled: {throttled:.2f}s\n"
+        received, decoded = self.counter('received_bytes'), self.counter('decoded_bytes')
+        if received:
+            val = val + f"Transferred: {received / 1024:.0f} KiB, {decoded / 1024:.0f} KiB decoded\n"
+        return val
+
+
+metrics = Metrics()
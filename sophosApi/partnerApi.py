@@ -1,14 +1,15 @@
-from typing import Dict, NamedTuple
+from typing import Dict, NamedTuple, Optional
 
 import requests
 
 import sophosApi.commonApi as commonApi
 import sophosApi.endpointApi as endpointApi
-from .helpers import dicter
+from .helpers import dicter, paginate_pages
 
 __all__ = {
     'PartnerApi',
-    'Tenant'
+    'Tenant',
+    'tenant_handle'
 }
 
 
@@ -26,6 +27,36 @@ class Tenant(NamedTuple):
     partner: str
 
 
+def _dict_to_tenant(ten: Dict, alerts, endpoints) -> Tenant:
+    return Tenant(alerts,
+                  ten['apiHost'],
+                  ten['billingType'],
+                  ten['dataGeography'],
+                  ten['dataRegion'],
+                  endpoints,
+                  ten['id'],
+                  ten['name'],
+                  str(ten['name']).split()[0] or ten['name'],
+                  dicter(ten['organization']).get('id'),
+                  dicter(ten['partner']).get('id'))
+
+
+def tenant_handle(getter: requests.get, t_id: str, apiHost: str, name: Optional[str] = None) -> Tenant:
+    """Tenant built from a known id and apiHost without asking the partner api.
+    Only alerts, endpoints, apiHost, id and name are populated."""
+    return Tenant(commonApi.CommonApi(getter, t_id, apiHost).alerts,
+                  apiHost,
+                  None,
+                  None,
+                  None,
+                  endpointApi.EndpointApi(getter, t_id, apiHost).endpoints,
+                  t_id,
+                  name,
+                  str(name or '').split()[0] if name else name,
+                  None,
+                  None)
+
+
 class PartnerApi(object):
     """https://developer.sophos.com/docs/partner-v1/1/overview
     Allows creation but not updation. Lets just go with read only read all for now."""
@@ -37,32 +68,16 @@ class PartnerApi(object):
 
     @property
     def tenants(self) -> Dict[str, Tenant]:
-        """https://developer.sophos.com/docs/partner-v1/1/routes/tenants/get"""
-        maxSize = 100
-        params = {"page": 1,
-                  "pageSize": maxSize}
+        """https://developer.sophos.com/docs/partner-v1/1/routes/tenants/get
+        Page 1 reports the page total, the remaining pages are fetched in parallel.
+        Raises IncompleteListing if a page fails, rather than return some of the tenants."""
         tenants = list()
-        while True:
-            result = self._request('get', f"{self.baseurl}tenants", headers=self.headers, params=params)
-            json = result.json()
-            params['page'] += 1
-            if result:
-                tenants.extend(json['items'])
-            if len(json['items']) < maxSize:
-                break
-            params['pageSize'] = json['pages']['maxSize']
+        for page in paginate_pages(self._request, f"{self.baseurl}tenants", self.headers, {"pageSize": 100}):
+            tenants.extend(page)
         tenants = dict([(ten['id'],
-                         Tenant(commonApi.CommonApi(self._request, ten['id'], ten['apiHost']).alerts,
-                                ten['apiHost'],
-                                ten['billingType'],
-                                ten['dataGeography'],
-                                ten['dataRegion'],
-                                endpointApi.EndpointApi(self._request, ten['id'], ten['apiHost']).endpoints,
-                                ten['id'],
-                                ten['name'],
-                                str(ten['name']).split()[0] or ten['name'],
-                                dicter(ten['organization']).get('id'),
-                                dicter(ten['partner']).get('id')))
+                         _dict_to_tenant(ten,
+                                         commonApi.CommonApi(self._request, ten['id'], ten['apiHost']).alerts,
+                                         endpointApi.EndpointApi(self._request, ten['id'], ten['apiHost']).endpoints))
                         for ten in tenants])
         return tenants
 
@@ -72,17 +87,9 @@ class PartnerApi(object):
             raise KeyError
         if result:
             ten = result.json()
-            return Tenant(commonApi.CommonApi(self._request, ten['id'], ten['apiHost']).alerts,
-                          ten['apiHost'],
-                          ten['billingType'],
-                          ten['dataGeography'],
-                          ten['dataRegion'],
-                          endpointApi.EndpointApi(self._request, ten['id'], ten['apiHost']).endpoints,
-                          ten['id'],
-                          ten['name'],
-                          str(ten['name']).split()[0] or ten['name'],
-                          dicter(ten['organization']).get('id'),
-                          dicter(ten['partner']).get('id'))
+            return _dict_to_tenant(ten,
+                                   commonApi.CommonApi(self._request, ten['id'], ten['apiHost']).alerts,
+                                   endpointApi.EndpointApi(self._request, ten['id'], ten['apiHost']).endpoints)
         else:
             raise Exception("Unexpected exception!")
 
@@ -0,0 +1,165 @@
+"""
+Client side rate limiting and retry budgeting shared by every request of a client.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from random import uniform
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+__all__ = [
+    'TokenBucket',
+    'RateLimiter'
+]
+
+
+class TokenBucket(object):
+    """Thread safe token bucket. Callers reserve a token and are told how long to wait for it."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """
+        :param float rate: tokens added per second
+        :param int burst: bucket size
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returns seconds to wait before using it."""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            return max(wait, self._paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller for at least this long, e.g. when the server sent Retry-After."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+
+# Numeric hints past this are epoch timestamps rather than seconds to wait, it is 2001-09-09
+_epoch = 10 ** 9
+
+
+def _seconds(value: str) -> float:
+    """Seconds to wait from a numeric hint, either a delay or an epoch timestamp to wait until."""
+    seconds = float(value)
+    if seconds >= _epoch:
+        seconds = seconds - time()
+    return max(0.0, seconds)
+
+
+def _retry_after(headers) -> Optional[float]:
+    """Seconds the server asked us to wait, from Retry-After or a rate limit reset header."""
+    value = headers.get('Retry-After')
+    if value is not None:
+        try:
+            return _seconds(value)
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    for name in ('RateLimit-Reset', 'X-RateLimit-Reset'):
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return _seconds(value)
+            except ValueError:
+                pass
+    return None
+
+
+class RateLimiter(object):
+    """Token bucket per api host and tenant, with a retry budget for 429s, 5xxs and connection errors."""
+
+    def __init__(self, rate: float = 10.0, burst: int = 10, max_retries: int = 8, deadline: float = 300.0,
+                 max_backoff: float = 30.0) -> None:
+        """
+        :param float rate: requests per second per api host and tenant
+        :param int burst: requests allowed at once before rate applies
+        :param int max_retries: retries per request before giving up
+        :param float deadline: seconds a request may spend retrying before giving up
+        :param float max_backoff: longest backoff when the server gives no hint
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.max_backoff = max_backoff
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = Lock()
+        self._stats = defaultdict(float)
+
+    @staticmethod
+    def key(url: str, headers: Optional[Dict] = None) -> Tuple[str, str]:
+        headers = headers or {}
+        return urlsplit(url).netloc, headers.get('X-Tenant-ID') or headers.get('X-Partner-ID') or ''
+
+    def bucket(self, key: Tuple[str, str]) -> TokenBucket:
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return self._buckets[key]
+
+    def count(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def reserve(self, key: Tuple[str, str]) -> float:
+        """Seconds to wait before sending a request for key."""
+        wait = self.bucket(key).reserve()
+        self.count('requests')
+        if wait > 0:
+            self.count('throttled')
+            self.count('throttle_seconds', wait)
+        return wait
+
+    def retry_delay(self, key: Tuple[str, str], status_code: int, headers, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying a response, or None if it should not be retried.
+        A server hint is followed but capped at the deadline, a longer one fails allow_retry anyway."""
+        if status_code != 429 and not 500 <= status_code < 600:
+            return None
+        self.count(f'status_{status_code}')
+        hint = _retry_after(headers)
+        if hint is not None:
+            return min(hint, self.deadline)
+        return uniform(0, min(self.max_backoff, 2 ** attempt))
+
+    def hold(self, key: Tuple[str, str], headers, delay: float) -> None:
+        """Once a retry is allowed, make everybody talking to this host and tenant wait out a server hint too,
+        not just us."""
+        if _retry_after(headers) is not None:
+            self.bucket(key).pause(delay)
+
+    def exception_delay(self, attempt: int) -> float:
+        self.count('errors')
+        return uniform(0, min(self.max_backoff, 2 ** attempt))
+
+    def allow_retry(self, attempt: int, started: float, delay: float) -> bool:
+        """Whether attempt fits in the retry budget and deadline. Counts the retry if it does."""
+        if attempt > self.max_retries or monotonic() + delay - started > self.deadline:
+            self.count('gave_up')
+            logging.error(f"Giving up after {attempt - 1} retries")
+            return False
+        self.count('retries')
+        self.count('retry_seconds', delay)
+        if attempt > 5:
+            logging.warning(f"This is the {attempt} retry.")
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        """Counters: requests, throttled, throttle_seconds, retries, retry_seconds, errors, gave_up, status_*"""
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,47 @@
+"""
+Record types shared by the api modules and the local cache.
+
+Kept apart from endpointApi and commonApi so the cache can load them without pulling in requests.
+"""
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+__all__ = [
+    'Alert',
+    'AlertDelta',
+    'Endpoint'
+]
+
+
+class Endpoint(NamedTuple):
+    id: str
+    type: str
+    tenant: str
+    hostname: str
+    health: str
+    os: str
+    ipAddresses: Optional[List[str]]
+    macAddresses: Optional[List[str]]
+    group: Optional[str]
+    tamperProtectionEnabled: bool
+    lastSeenAt: datetime
+
+
+class Alert(NamedTuple):
+    id: str
+    allowedActions: List[str]
+    category: str
+    description: str
+    groupKey: str
+    managedAgent: str
+    product: str
+    raisedAt: datetime
+    severity: str
+    tenant: str
+    type: str
+
+
+class AlertDelta(NamedTuple):
+    added: List[Alert]
+    removed: List[str]
+    watermark: Optional[datetime]
@@ -0,0 +1,430 @@
+"""
+Local SQLite cache for tenants, endpoints and alerts.
+
+Every row carries the time it was fetched, reads only return rows younger than the resource's TTL.
+"""
+import json
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from threading import RLock
+from time import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Type, TypeVar
+
+from .records import Alert, AlertDelta, Endpoint
+
+__all__ = [
+    'Store',
+    'default_path'
+]
+
+default_path = Path.home() / 'sophosCache.db'
+
+R = TypeVar('R', Endpoint, Alert)
+
+_schema = """
+CREATE TABLE IF NOT EXISTS tenants (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    apiHost TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS endpoints (
+    id TEXT PRIMARY KEY,
+    tenant TEXT NOT NULL,
+    hostname TEXT,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS endpoints_tenant ON endpoints (tenant);
+CREATE INDEX IF NOT EXISTS endpoints_hostname ON endpoints (hostname COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS alerts (
+    id TEXT PRIMARY KEY,
+    tenant TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS alerts_tenant ON alerts (tenant);
+CREATE TABLE IF NOT EXISTS watermarks (
+    resource TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    watermark TEXT,
+    full_at REAL NOT NULL,
+    PRIMARY KEY (resource, tenant)
+);
+CREATE TABLE IF NOT EXISTS collections (
+    resource TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (resource, tenant)
+);
+CREATE TABLE IF NOT EXISTS crawls (
+    name TEXT PRIMARY KEY,
+    resource TEXT NOT NULL,
+    query TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS crawl_tenants (
+    crawl TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    name TEXT,
+    apiHost TEXT,
+    cursor TEXT,
+    records INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (crawl, tenant)
+);
+CREATE TABLE IF NOT EXISTS crawl_records (
+    crawl TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (crawl, id)
+);
+CREATE INDEX IF NOT EXISTS crawl_records_tenant ON crawl_records (crawl, tenant);
+"""
+
+
+def _encode(record) -> str:
+    return json.dumps(dict([(k, v.isoformat() if isinstance(v, datetime) else v)
+                            for k, v in record._asdict().items()]))
+
+
+def _decode(cls: Type[R], data: str) -> R:
+    d = json.loads(data)
+    for k, t in cls.__annotations__.items():
+        if t is datetime and d.get(k) is not None:
+            d[k] = datetime.fromisoformat(d[k])
+    return cls(**d)
+
+
+class Store(object):
+    """SQLite (WAL mode) cache. Safe to share between threads."""
+    ttls = {'tenants': 24 * 3600, 'endpoints': 15 * 60, 'alerts': 5 * 60}
+    batch = 500
+
+    def __init__(self, path=default_path, ttls: Optional[Dict[str, int]] = None) -> None:
+        """
+        :param path: database file
+        :param dict ttls: seconds a resource stays fresh, by resource name
+        """
+        self.path = Path(path)
+        self.ttls = dict(self.ttls, **(ttls or {}))
+        self._lock = RLock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_schema)
+
+    def _cutoff(self, resource: str) -> float:
+        return time() - self.ttls[resource]
+
+    def _fresh_collection(self, resource: str, t_id: str) -> bool:
+        row = self._db.execute('SELECT fetched_at FROM collections WHERE resource = ? AND tenant = ?',
+                               (resource, t_id)).fetchone()
+        return row is not None and row[0] >= self._cutoff(resource)
+
+    def _mark_collection(self, resource: str, t_id: str, fetched_at: float) -> None:
+        self._db.execute('INSERT OR REPLACE INTO collections VALUES (?, ?, ?)', (resource, t_id, fetched_at))
+
+    # Tenants
+    def put_tenants(self, tenants: Iterable) -> None:
+        """Replace all tenants. Accepts Tenant tuples or dicts with id, name and apiHost."""
+        now = time()
+        rows = [(t['id'], t['name'], t['apiHost'], now) if isinstance(t, dict) else (t.id, t.name, t.apiHost, now)
+                for t in tenants]
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM tenants')
+            self._db.executemany('INSERT INTO tenants VALUES (?, ?, ?, ?)', rows)
+            self._mark_collection('tenants', '', now)
+
+    def tenants(self) -> Optional[Dict[str, Dict]]:
+        """All tenants as {id: {'id', 'name', 'apiHost'}}, or None if they are missing or stale."""
+        with self._lock:
+            if not self._fresh_collection('tenants', ''):
+                return None
+            rows = self._db.execute('SELECT id, name, apiHost FROM tenants ORDER BY name').fetchall()
+        return dict([(row[0], {'id': row[0], 'name': row[1], 'apiHost': row[2]}) for row in rows])
+
+    def tenant(self, t_id: str, fresh: bool = True) -> Optional[Dict]:
+        """Tenant as {'id', 'name', 'apiHost'}, or None.
+        :param bool fresh: ignore tenants older than the ttl
+        """
+        with self._lock:
+            row = self._db.execute('SELECT id, name, apiHost FROM tenants WHERE id = ? AND fetched_at >= ?',
+                                   (t_id, self._cutoff('tenants') if fresh else 0)).fetchone()
+        if row is None:
+            return None
+        return {'id': row[0], 'name': row[1], 'apiHost': row[2]}
+
+    def put_tenant(self, tenant) -> None:
+        """Add or replace one tenant. Accepts a Tenant tuple or a dict with id, name and apiHost."""
+        t = tenant if isinstance(tenant, dict) else {'id': tenant.id, 'name': tenant.name, 'apiHost': tenant.apiHost}
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO tenants VALUES (?, ?, ?, ?)',
+                             (t['id'], t['name'], t['apiHost'], time()))
+
+    # Endpoints and alerts
+    @staticmethod
+    def _rows(resource: str, t_id: str, records: List, now: float) -> Tuple[str, List[Tuple]]:
+        if resource == 'endpoints':
+            return ('INSERT OR REPLACE INTO endpoints VALUES (?, ?, ?, ?, ?)',
+                    [(r.id, t_id, r.hostname, _encode(r), now) for r in records])
+        return 'INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?)', [(r.id, t_id, _encode(r), now) for r in records]
+
+    def _put(self, resource: str, t_id: str, records: List) -> None:
+        sql, rows = self._rows(resource, t_id, records, time())
+        with self._lock, self._db:
+            self._db.executemany(sql, rows)
+
+    def _record(self, resource: str, t_id: str, records: Iterable[R]) -> Iterator[R]:
+        """Pass records through while writing them in batches.
+        Only once records are exhausted without error is the tenant's collection replaced and marked fresh. A
+        listing that raises, e.g. IncompleteListing, or is abandoned part way leaves the older rows in place."""
+        started = time()
+        batch = list()
+        complete = False
+        try:
+            for record in records:
+                batch.append(record)
+                if len(batch) >= self.batch:
+                    self._put(resource, t_id, batch)
+                    batch = list()
+                yield record
+            complete = True
+        finally:
+            self._put(resource, t_id, batch)
+        if complete:
+            with self._lock, self._db:
+                self._db.execute(f'DELETE FROM {resource} WHERE tenant = ? AND fetched_at < ?', (t_id, started))
+                self._mark_collection(resource, t_id, started)
+
+    def _get(self, cls: Type[R], resource: str, r_id: str) -> Optional[R]:
+        with self._lock:
+            row = self._db.execute(f'SELECT data FROM {resource} WHERE id = ? AND fetched_at >= ?',
+                                   (r_id, self._cutoff(resource))).fetchone()
+        return None if row is None else _decode(cls, row[0])
+
+    def _all(self, cls: Type[R], resource: str, t_id: str, fresh: bool = True) -> Optional[List[R]]:
+        with self._lock:
+            if fresh and not self._fresh_collection(resource, t_id):
+                return None
+            rows = self._db.execute(f'SELECT data FROM {resource} WHERE tenant = ?', (t_id,)).fetchall()
+        return [_decode(cls, row[0]) for row in rows]
+
+    def record_endpoints(self, t_id: str, endpoints: Iterable[Endpoint]) -> Iterator[Endpoint]:
+        """Cache a full endpoint listing for a tenant as it streams past."""
+        return self._record('endpoints', t_id, endpoints)
+
+    def put_endpoints(self, t_id: str, endpoints: Iterable[Endpoint]) -> None:
+        self._put('endpoints', t_id, list(endpoints))
+
+    def endpoint(self, e_id: str) -> Optional[Endpoint]:
+        """Fresh endpoint by id, or None."""
+        return self._get(Endpoint, 'endpoints', e_id)
+
+    def endpoints_by_hostname(self, hostname: str) -> List[Endpoint]:
+        """Fresh endpoints with this hostname, case insensitive."""
+        with self._lock:
+            rows = self._db.execute('SELECT data FROM endpoints WHERE hostname = ? COLLATE NOCASE '
+                                    'AND fetched_at >= ?', (hostname, self._cutoff('endpoints'))).fetchall()
+        return [_decode(Endpoint, row[0]) for row in rows]
+
+    def endpoints(self, t_id: str) -> Optional[List[Endpoint]]:
+        """All endpoints of a tenant, or None if the last full listing is stale."""
+        return self._all(Endpoint, 'endpoints', t_id)
+
+    def record_alerts(self, t_id: str, alerts: Iterable[Alert]) -> Iterator[Alert]:
+        """Cache a full alert listing for a tenant as it streams past."""
+        return self._record('alerts', t_id, alerts)
+
+    def put_alerts(self, t_id: str, alerts: Iterable[Alert]) -> None:
+        self._put('alerts', t_id, list(alerts))
+
+    def alert(self, a_id: str) -> Optional[Alert]:
+        """Fresh alert by id, or None."""
+        return self._get(Alert, 'alerts', a_id)
+
+    def alerts(self, t_id: str) -> Optional[List[Alert]]:
+        """All alerts of a tenant, or None if the last full listing is stale."""
+        return self._all(Alert, 'alerts', t_id)
+
+    def watermark(self, t_id: str, resource: str = 'alerts') -> Tuple[Optional[datetime], Optional[float]]:
+        """Last synced high-water mark of a tenant's resource, and when it was last fully reconciled."""
+        with self._lock:
+            row = self._db.execute('SELECT watermark, full_at FROM watermarks WHERE resource = ? AND tenant = ?',
+                                   (resource, t_id)).fetchone()
+        if row is None:
+            return None, None
+        return (None if row[0] is None else datetime.fromisoformat(row[0])), row[1]
+
+    def sync_alerts(self, t_id: str, alerts, full_every: int = 3600) -> AlertDelta:
+        """Incrementally sync a tenant's alerts into the cache from its persisted watermark.
+        Falls back to a full fetch when there is no watermark, or the last full one is older than full_every
+        seconds, so alerts actioned outside this client are eventually pruned too.
+        Only a full fetch refreshes the cached collection: an incremental one can't see alerts actioned elsewhere,
+        so it adds new alerts without making alerts() trust the rest for another TTL.
+        If the listing fails part way, IncompleteListing is raised and the cache is left untouched.
+        The persisted watermark only ever moves forward.
+        :param commonApi.Alerts alerts: the tenant's alerts api
+        """
+        previous, full_at = self.watermark(t_id)
+        watermark = previous
+        if watermark is None or full_at is None or time() - full_at >= full_every:
+            watermark = None
+        known = dict([(alert.id, alert) for alert in self._all(Alert, 'alerts', t_id, fresh=False)])
+        delta = alerts.sync(watermark, known)
+        latest = max([w for w in (previous, delta.watermark) if w is not None], default=None)
+        now = time()
+        self._put('alerts', t_id, delta.added)
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM alerts WHERE id = ?', [(a_id,) for a_id in delta.removed])
+            self._db.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)',
+                             ('alerts', t_id, None if latest is None else latest.isoformat(),
+                              now if watermark is None else full_at))
+            if watermark is None:
+                self._db.execute('UPDATE alerts SET fetched_at = ? WHERE tenant = ?', (now, t_id))
+                self._mark_collection('alerts', t_id, now)
+        return delta
+
+    def forget_alert(self, a_id: str) -> None:
+        """Drop an alert that has been actioned."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM alerts WHERE id = ?', (a_id,))
+
+    # Crawls
+    def crawl(self, name: str) -> Optional[Dict]:
+        """Checkpointed crawl as {'name', 'resource', 'query', 'started_at', 'finished_at'}, or None."""
+        with self._lock:
+            row = self._db.execute('SELECT name, resource, query, started_at, finished_at FROM crawls WHERE name = ?',
+                                   (name,)).fetchone()
+        if row is None:
+            return None
+        return {'name': row[0], 'resource': row[1], 'query': None if row[2] is None else json.loads(row[2]),
+                'started_at': row[3], 'finished_at': row[4]}
+
+    def crawl_start(self, name: str, resource: str, tenants: Iterable, query: Optional[Dict] = None) -> None:
+        """Checkpoint a new crawl of resource over tenants, replacing any earlier crawl of the same name.
+        Accepts Tenant tuples or dicts with id, name and apiHost."""
+        rows = [(name, t['id'], t['name'], t['apiHost']) if isinstance(t, dict) else (name, t.id, t.name, t.apiHost)
+                for t in tenants]
+        with self._lock, self._db:
+            self._forget_crawl(name)
+            now = time()
+            self._db.execute('INSERT INTO crawls VALUES (?, ?, ?, ?, ?)',
+                             (name, resource, None if query is None else json.dumps(query), now,
+                              None if rows else now))
+            self._db.executemany('INSERT INTO crawl_tenants (crawl, tenant, name, apiHost) VALUES (?, ?, ?, ?)', rows)
+
+    def crawl_pending(self, name: str) -> List[Dict]:
+        """Tenants of a crawl that are not done, as {'id', 'name', 'apiHost', 'cursor', 'records'}.
+        cursor is None for tenants that have not finished a page yet."""
+        with self._lock:
+            rows = self._db.execute('SELECT tenant, name, apiHost, cursor, records FROM crawl_tenants '
+                                    'WHERE crawl = ? AND NOT done ORDER BY name', (name,)).fetchall()
+        return [{'id': row[0], 'name': row[1], 'apiHost': row[2],
+                 'cursor': None if row[3] is None else json.loads(row[3]), 'records': row[4]} for row in rows]
+
+    def crawl_page(self, name: str, t_id: str, records: List[R], cursor: Optional[Dict]) -> int:
+        """Checkpoint one page of a tenant: its records and the cursor of the page after it, in one transaction,
+        so a crawl interrupted at any point resumes from exactly the last page written.
+        A None cursor marks the tenant done. If the crawl has no query, its listing is complete and unprojected,
+        and then replaces the tenant's cached one.
+        :return: records checkpointed for the tenant so far
+        """
+        now = time()
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO crawl_records VALUES (?, ?, ?, ?)',
+                                 [(name, t_id, r.id, _encode(r)) for r in records])
+            count = self._db.execute('SELECT COUNT(*) FROM crawl_records WHERE crawl = ? AND tenant = ?',
+                                     (name, t_id)).fetchone()[0]
+            self._db.execute('UPDATE crawl_tenants SET cursor = ?, records = ?, done = ?, error = NULL '
+                             'WHERE crawl = ? AND tenant = ?',
+                             (None if cursor is None else json.dumps(cursor), count, cursor is None, name, t_id))
+            if cursor is not None:
+                return count
+            resource, query = self._db.execute('SELECT resource, query FROM crawls WHERE name = ?',
+                                               (name,)).fetchone()
+            # Only a complete, unprojected listing may replace the cached one
+            if query is None:
+                cls = Endpoint if resource == 'endpoints' else Alert
+                rows = self._db.execute('SELECT data FROM crawl_records WHERE crawl = ? AND tenant = ?',
+                                        (name, t_id)).fetchall()
+                sql, rows = self._rows(resource, t_id, [_decode(cls, row[0]) for row in rows], now)
+                self._db.executemany(sql, rows)
+                self._db.execute(f'DELETE FROM {resource} WHERE tenant = ? AND fetched_at < ?', (t_id, now))
+                self._mark_collection(resource, t_id, now)
+            self._db.execute('UPDATE crawls SET finished_at = ? WHERE name = ? AND NOT EXISTS '
+                             '(SELECT 1 FROM crawl_tenants WHERE crawl = ? AND NOT done)', (now, name, name))
+        return count
+
+    def crawl_failed(self, name: str, t_id: str, error: str) -> None:
+        """Note why a tenant stopped. Its cursor is kept, the next run resumes it."""
+        with self._lock, self._db:
+            self._db.execute('UPDATE crawl_tenants SET error = ? WHERE crawl = ? AND tenant = ?', (error, name, t_id))
+
+    def crawl_status(self, name: str) -> Dict[str, int]:
+        """Tenants, tenants done, tenants whose last attempt failed and records checkpointed."""
+        with self._lock:
+            tenants, done, failed, records = self._db.execute(
+                'SELECT COUNT(*), SUM(done), SUM(error IS NOT NULL), SUM(records) FROM crawl_tenants WHERE crawl = ?',
+                (name,)).fetchone()
+        return {'tenants': tenants, 'done': done or 0, 'failed': failed or 0, 'records': records or 0}
+
+    def crawl_records(self, name: str) -> Iterator[Tuple[str, R]]:
+        """(tenant id, record) for every record checkpointed by a crawl, read in batches."""
+        crawl = self.crawl(name)
+        if crawl is None:
+            return
+        cls = Endpoint if crawl['resource'] == 'endpoints' else Alert
+        last = ('', '')
+        while True:
+            with self._lock:
+                rows = self._db.execute('SELECT tenant, id, data FROM crawl_records WHERE crawl = ? AND (tenant, id) > '
+                                        '(?, ?) ORDER BY tenant, id LIMIT ?', (name,) + last + (self.batch,)).fetchall()
+            for row in rows:
+                yield row[0], _decode(cls, row[2])
+            if len(rows) < self.batch:
+                return
+            last = (rows[-1][0], rows[-1][1])
+
+    def _forget_crawl(self, name: str) -> None:
+        for table, column in (('crawls', 'name'), ('crawl_tenants', 'crawl'), ('crawl_records', 'crawl')):
+            self._db.execute(f'DELETE FROM {table} WHERE {column} = ?', (name,))
+
+    def forget_crawl(self, name: str) -> None:
+        """Drop a crawl's checkpoint and records."""
+        with self._lock, self._db:
+            self._forget_crawl(name)
+
+    # Management
+    def stats(self) -> Dict[str, Dict]:
+        """Row counts, fresh row counts and ages per resource."""
+        stats = dict()
+        now = time()
+        with self._lock:
+            for resource in ('tenants', 'endpoints', 'alerts'):
+                total, fresh, oldest, newest = self._db.execute(
+                    f'SELECT COUNT(*), SUM(fetched_at >= ?), MIN(fetched_at), MAX(fetched_at) FROM {resource}',
+                    (self._cutoff(resource),)).fetchone()
+                stats[resource] = {'rows': total,
+                                   'fresh': fresh or 0,
+                                   'ttl': self.ttls[resource],
+                                   'oldest_age': None if oldest is None else int(now - oldest),
+                                   'newest_age': None if newest is None else int(now - newest)}
+        stats['file'] = {'path': str(self.path), 'bytes': self.path.stat().st_size if self.path.exists() else 0}
+        return stats
+
+    def clear(self) -> None:
+        with self._lock, self._db:
+            for table in ('tenants', 'endpoints', 'alerts', 'watermarks', 'collections', 'crawls', 'crawl_tenants',
+                          'crawl_records'):
+                self._db.execute(f'DELETE FROM {table}')
+        with self._lock:
+            self._db.execute('VACUUM')
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
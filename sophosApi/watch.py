@@ -0,0 +1,196 @@
+"""
+Long running alert watcher.
+
+Keeps one ApiClient and Store alive and incrementally syncs the alerts of many tenants, reporting new and
+resolved alerts to sinks. Each tenant is polled on its own interval: active tenants are polled often, quiet ones
+back off, and every interval stretches while the api is throttling us.
+"""
+import heapq
+import json
+import logging
+import sys
+from datetime import datetime, timezone
+from threading import Event
+from time import monotonic
+from typing import Callable, Dict, IO, Iterable, List, NamedTuple, Optional
+
+import requests
+
+from .commonApi import Alert
+from .partnerApi import Tenant
+from .store import Store
+
+__all__ = [
+    'WatchEvent',
+    'Watcher',
+    'stdout_sink',
+    'jsonl_sink',
+    'webhook_sink'
+]
+
+
+class WatchEvent(NamedTuple):
+    kind: str  # added or removed
+    tenant: str
+    alert_id: str
+    alert: Optional[Alert]  # None for removed alerts
+    at: datetime
+
+    def as_dict(self) -> Dict:
+        alert = None
+        if self.alert is not None:
+            alert = dict([(k, v.isoformat() if isinstance(v, datetime) else v)
+                          for k, v in self.alert._asdict().items()])
+        return {'event': self.kind, 'tenant': self.tenant, 'alertId': self.alert_id, 'at': self.at.isoformat(),
+                'alert': alert}
+
+
+Sink = Callable[[List[WatchEvent]], None]
+
+
+def stdout_sink(stream: Optional[IO] = None) -> Sink:
+    """Events as lines, the same as alert sync: + tenant id description, or - tenant id."""
+
+    def sink(events: List[WatchEvent]) -> None:
+        out = stream or sys.stdout
+        for event in events:
+            if event.kind == 'added':
+                out.write(f"+\t{event.tenant}\t{event.alert_id}\t{event.alert.description}\n")
+            else:
+                out.write(f"-\t{event.tenant}\t{event.alert_id}\n")
+        out.flush()
+
+    return sink
+
+
+def jsonl_sink(path: str) -> Sink:
+    """Append events to a JSON Lines file, one object per event."""
+
+    def sink(events: List[WatchEvent]) -> None:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(''.join([json.dumps(event.as_dict()) + '\n' for event in events]))
+
+    return sink
+
+
+def webhook_sink(url: str, timeout: float = 10.0) -> Sink:
+    """POST each batch of events as {"events": [...]} to url. Failures are logged, the watcher carries on."""
+    session = requests.Session()
+
+    def sink(events: List[WatchEvent]) -> None:
+        try:
+            result = session.post(url, json={'events': [event.as_dict() for event in events]}, timeout=timeout)
+            if not result:
+                logging.error(f"Webhook {url} returned {result.status_code}")
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Webhook {url} failed: {e}")
+
+    return sink
+
+
+class Watcher(object):
+    """Poll alerts of many tenants on adaptive intervals and send changes to sinks.
+
+        watcher = Watcher(client, Store(), sinks=[stdout_sink()])
+        watcher.run()
+    """
+
+    def __init__(self, client, store: Store, tenants: Optional[Iterable[Tenant]] = None,
+                 sinks: Iterable[Sink] = (), min_interval: float = 30.0, max_interval: float = 900.0,
+                 backoff: float = 1.5, full_every: int = 3600, emit_initial: bool = False,
+                 max_workers: int = 16) -> None:
+        """
+        :param ApiClient client: kept for the life of the watcher, its limiter tells us when to slow down
+        :param tenants: tenants to watch, defaults to every tenant of the partner
+        :param sinks: called with each non-empty batch of WatchEvents
+        :param float min_interval: seconds between polls of a tenant with new or resolved alerts
+        :param float max_interval: longest seconds between polls of a quiet tenant
+        :param float backoff: a quiet poll multiplies the tenant's interval by this much
+        :param int full_every: seconds between full reconciliations of a tenant, see Store.sync_alerts
+        :param bool emit_initial: report a tenant's existing alerts on its first sync, not just later changes
+        :param int max_workers: tenants polled at once
+        """
+        self.client = client
+        self.store = store
+        self.sinks = list(sinks)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.full_every = full_every
+        self.emit_initial = emit_initial
+        self.max_workers = max_workers
+        self._tenants: Dict[str, Tenant] = dict([(t.id, t) for t in (tenants if tenants is not None
+                                                                     else client.tenants.values())])
+        self._intervals = dict([(t_id, min_interval) for t_id in self._tenants])
+        # (due, tenant id), every tenant is due straight away
+        self._due = [(0.0, t_id) for t_id in self._tenants]
+        heapq.heapify(self._due)
+        self._pressure = 1.0
+        self._limiter_seen = self._limiter_pressure()
+
+    def _limiter_pressure(self) -> float:
+        stats = self.client.limiter.stats()
+        return sum([stats.get(k, 0) for k in ('throttled', 'status_429', 'errors', 'gave_up')])
+
+    def _adjust_pressure(self) -> None:
+        """Double every interval while the limiter is throttling or retrying, relax again once it stops."""
+        seen = self._limiter_pressure()
+        if seen > self._limiter_seen:
+            self._pressure = min(8.0, self._pressure * 2)
+            logging.info(f"Rate limit pressure, polling {self._pressure:g}x slower")
+        else:
+            self._pressure = max(1.0, self._pressure / 2)
+        self._limiter_seen = seen
+
+    def _reschedule(self, t_id: str, active: bool) -> None:
+        if active:
+            self._intervals[t_id] = self.min_interval
+        else:
+            self._intervals[t_id] = min(self.max_interval, self._intervals[t_id] * self.backoff)
+        self._retry(t_id)
+
+    def _retry(self, t_id: str) -> None:
+        heapq.heappush(self._due, (monotonic() + self._intervals[t_id] * self._pressure, t_id))
+
+    def next_due(self) -> float:
+        """Seconds until the next tenant is due."""
+        return max(0.0, self._due[0][0] - monotonic()) if self._due else self.max_interval
+
+    def poll(self) -> List[WatchEvent]:
+        """Sync every tenant that is due, send any changes to the sinks and return them.
+        A tenant whose sync fails or is incomplete reports nothing and is retried on its current interval."""
+        now = monotonic()
+        due = []
+        while self._due and self._due[0][0] <= now:
+            due.append(self._tenants[heapq.heappop(self._due)[1]])
+        if not due:
+            return []
+        # Never fully synced into the store, so everything it has would look new
+        first = set([t.id for t in due if self.store.watermark(t.id)[1] is None])
+        events = []
+        at = datetime.now(timezone.utc)
+        results = self.client.fan_out(lambda t: self.store.sync_alerts(t.id, t.alerts, self.full_every), due,
+                                      max_workers=self.max_workers)
+        for tenant, delta, error in results:
+            if error is not None:
+                # Store.sync_alerts left the store as it was, a partial listing must not look like resolved alerts
+                logging.warning(f"Alerts of tenant {tenant.id} not synced, retrying: {error}")
+                self._retry(tenant.id)
+                continue
+            self._reschedule(tenant.id, bool(delta.added or delta.removed))
+            if tenant.id in first and not self.emit_initial:
+                continue
+            events.extend([WatchEvent('added', tenant.id, alert.id, alert, at) for alert in delta.added])
+            events.extend([WatchEvent('removed', tenant.id, a_id, None, at) for a_id in delta.removed])
+        self._adjust_pressure()
+        if events:
+            for sink in self.sinks:
+                sink(events)
+        return events
+
+    def run(self, stop: Optional[Event] = None) -> None:
+        """Poll until stop is set, or forever."""
+        stop = stop or Event()
+        while not stop.is_set():
+            self.poll()
+            stop.wait(self.next_due())
@@ -6,19 +6,29 @@ Email: matt.jenkins@dataprise.com
 
 Version 1.0.0
 """
-from typing import Optional
-from sophosApi.apiClient import *
+from typing import Iterator, List, Optional
+from sophosApi.export import compressions, formats
 import configparser
 import argparse
 import logging
-import shelve
+import sys
 from pathlib import Path
-from pprint import pprint
-
-client: ApiClient
+from threading import Lock
+from time import perf_counter
+
+# The client, its oauth token and the cache are only built for commands that use them, see get_client and
+# get_cache. Modules that pull in requests are imported by the commands that need them.
+client = None
+cache = None
+credentials = {}
 identity: Optional[str] = None
 config_file = Path.home() / 'sophosCli.ini'
-cache = shelve.open(str(Path.home() / 'sophosCache'))
+cache_file = Path.home() / 'sophosCache.db'
+_lazy_lock = Lock()
+# Same as Endpoint._fields and EndpointIndex.indexed, which would import requests just to show --help
+endpoint_fields = ('id', 'type', 'tenant', 'hostname', 'health', 'os', 'ipAddresses', 'macAddresses', 'group',
+                   'tamperProtectionEnabled', 'lastSeenAt')
+endpoint_indexed = ('hostname', 'ip', 'mac', 'group', 'health', 'os', 'type')
 
 
 def get_tenants():
@@ -48,12 +58,7 @@ def get_config():
 
 
 def parse_config(vals):
-    if vals.get('client_id') is None or vals.get('client_id') == '':
-        raise ValueError("client_id is a required config item")
-    if vals.get('client_token') is None or vals.get('client_token') == '':
-        raise ValueError("client_token is a required config item")
-    global client
-    client = ApiClient(vals['client_id'], vals['client_token'])
+    credentials.update(client_id=vals.get('client_id'), client_token=vals.get('client_token'))
     levels = ['DEBUG', 'INFO', 'WARNING']
     if vals.get('log_level') is None or vals.get('log_level') not in levels:
         raise ValueError(f'log_level is a required value and must be one of {levels}')
@@ -64,6 +69,30 @@ def parse_config(vals):
         identity = vals['identity']
 
 
+def get_client():
+    """The api client, created on first use."""
+    global client
+    with _lazy_lock:
+        if client is None:
+            if not credentials.get('client_id'):
+                raise ValueError("client_id is a required config item")
+            if not credentials.get('client_token'):
+                raise ValueError("client_token is a required config item")
+            from sophosApi.apiClient import ApiClient
+            client = ApiClient(credentials['client_id'], credentials['client_token'])
+        return client
+
+
+def get_cache():
+    """The local cache, opened on first use."""
+    global cache
+    with _lazy_lock:
+        if cache is None:
+            from sophosApi.store import Store
+            cache = Store(cache_file)
+        return cache
+
+
 def update_config(key, value):
     config = configparser.ConfigParser()
     config['DEFAULT'] = get_config()
@@ -74,12 +103,30 @@ def update_config(key, value):
 
 def parse_cli():
     parser = argparse.ArgumentParser(description="Manage sophos alerts and endpoints via cli.")
+    parser.add_argument('--profile', action='store_true', help='Print where the time went to stderr at exit: per '
+                                                               'route latency, retries, pages and decode time.')
+    parser.add_argument('--profile-format', default='table', choices=['table', 'json', 'prometheus'],
+                        help='Format of the --profile output. Default table.')
     subparsers = parser.add_subparsers(title="commands")
 
     alert = subparsers.add_parser('alert', help='List alerts or manage alert.')
     alert = alert.add_subparsers(title='alert commands')
     alert_list = alert.add_parser('list', help="List all alerts")
+    alert_list.add_argument('--all-tenants', action='store_true', help="List alerts for every tenant of the partner.")
     alert_list.set_defaults(func=falert_list)
+    alert_bulk = alert.add_parser('bulk-action', help='Perform an allowed action on every alert matching a filter.')
+    alert_bulk.add_argument('action', help='Allowed action to perform on the alerts.')
+    alert_bulk.add_argument('--filter', required=True,
+                            help='Alerts to action, e.g. "severity=low, category=pua|policy, age>7d, type~Threat". '
+                                 'Clauses are ANDed. Operators: = != ~ > >= < <=.')
+    alert_bulk.add_argument('--all-tenants', action='store_true', help='Action alerts in every tenant.')
+    alert_bulk.add_argument('--workers', type=int, default=8, help='Concurrent requests per tenant. Default 8.')
+    alert_bulk.add_argument('--dry-run', action='store_true', help='Show what would be actioned without doing it.')
+    alert_bulk.set_defaults(func=falert_bulk_action)
+    alert_sync = alert.add_parser('sync', help="Fetch only alerts raised since the last sync and show what changed.")
+    alert_sync.add_argument('--full', action='store_true', help="Refetch every alert and prune resolved ones.")
+    alert_sync.add_argument('--all-tenants', action='store_true', help="Sync alerts for every tenant of the partner.")
+    alert_sync.set_defaults(func=falert_sync)
     alert_detail = alert.add_parser('detail', help="Show detailed information about an alert")
     alert_detail.add_argument('id', help="id from alert list to show details for.")
     alert_detail.set_defaults(func=falert_detail)
@@ -91,21 +138,78 @@ def parse_cli():
     endpoint = subparsers.add_parser('endpoint', help='List endpoints or manage endpoints.')
     endpoint = endpoint.add_subparsers(title='endpoint/managedAgent commands')
     endpoint_list = endpoint.add_parser('list', help='list all endpoints for a client')
+    endpoint_list.add_argument('--all-tenants', action='store_true',
+                               help='List endpoints for every tenant of the partner.')
+    endpoint_list.add_argument('--health', help='Overall health, comma separated: good, suspicious, bad, unknown.')
+    endpoint_list.add_argument('--type', help='Endpoint type, comma separated: computer, server, securityVm.')
+    endpoint_list.add_argument('--last-seen-before', help='ISO 8601 time, or a duration such as -P30D.')
+    endpoint_list.add_argument('--last-seen-after', help='ISO 8601 time, or a duration such as -P1D.')
+    endpoint_list.add_argument('--hostname', help='Hostname contains.')
+    endpoint_list.add_argument('--group', help='Group name contains.')
+    endpoint_list.add_argument('--tamper-protection', choices=['on', 'off'], help='Tamper protection state.')
+    endpoint_list.add_argument('--search', help='Free text search.')
+    endpoint_list.add_argument('--fields', help=f"Comma separated fields to show, from {', '.join(endpoint_fields)}.")
     endpoint_list.set_defaults(func=fendpoint_list)
+    endpoint_find = endpoint.add_parser('find', help='Find endpoints or count them by field, from the local cache.')
+    for name in endpoint_indexed:
+        endpoint_find.add_argument(f'--{name}', help=f'Exact {name} to match.')
+    endpoint_find.add_argument('--count-by', help="Count endpoints per value of a field, e.g. os or health.")
+    endpoint_find.set_defaults(func=fendpoint_find)
     endpoint_detail = endpoint.add_parser('detail', help='Show detailed information about an endpoint')
     endpoint_detail.add_argument('id', help='id from endpoint list to show details for.')
     endpoint_detail.set_defaults(func=fendpoint_detail)
-    endpoint_scan = endpoint.add_parser('scan', help='Queue a scan of the endpoint.')
-    endpoint_scan.add_argument('id', help="id of endpoint to scan")
+    endpoint_scan = endpoint.add_parser('scan', help='Queue a scan of one or more endpoints.')
+    add_bulk_arguments(endpoint_scan, 'scan')
     endpoint_scan.set_defaults(func=fendpoint_scan)
-    endpoint_update = endpoint.add_parser('update', help='Queue updates for Sophos.')
-    endpoint_update.add_argument('id', help='id of endpoint to update')
+    endpoint_update = endpoint.add_parser('update', help='Queue updates for Sophos on one or more endpoints.')
+    add_bulk_arguments(endpoint_update, 'update')
     endpoint_update.set_defaults(func=fendpoint_update)
 
     cache = subparsers.add_parser('cache', help='Manage local cli cache.')
     cache = cache.add_subparsers(title='Cache management commands')
     cache_clear = cache.add_parser('clear', help='Delete cache. Next run will take longer.')
     cache_clear.set_defaults(func=fcache_clear)
+    cache_stats = cache.add_parser('stats', help='Show cached rows, freshness and cache size.')
+    cache_stats.set_defaults(func=fcache_stats)
+    cache_warm = cache.add_parser('warm', help='Refresh tenants, and endpoints and alerts of the current tenant.')
+    cache_warm.add_argument('--all-tenants', action='store_true', help='Warm endpoints and alerts of every tenant.')
+    cache_warm.set_defaults(func=fcache_warm)
+
+    export = subparsers.add_parser('export', help='Export endpoints or alerts to csv, jsonl or parquet.')
+    export.add_argument('resource', choices=['endpoints', 'alerts'], help='What to export.')
+    export.add_argument('--all-tenants', action='store_true', help='Export every tenant of the partner.')
+    export.add_argument('--format', default='csv', choices=formats, help='Output format. Default csv.')
+    export.add_argument('--fields', help='Comma separated fields to export. Default all.')
+    export.add_argument('--output', default='-', help='File to write. Default stdout.')
+    export.add_argument('--compress', help=f"Compression, one of {list(compressions)}, or a parquet codec.")
+    export.set_defaults(func=fexport)
+
+    crawl = subparsers.add_parser('crawl', help='Fetch endpoints or alerts of every tenant into the cache, '
+                                                'checkpointing each page. Run again to resume an interrupted crawl, '
+                                                'or to start a new one once it has finished.')
+    crawl.add_argument('resource', choices=['endpoints', 'alerts'], help='What to crawl.')
+    crawl.add_argument('--name', help='Checkpoint name, to keep several crawls apart. Default the resource.')
+    crawl.add_argument('--restart', action='store_true', help='Drop an unfinished checkpoint and crawl every '
+                                                              'tenant again.')
+    crawl.add_argument('--workers', type=int, default=16, help='Tenants crawled at once. Default 16.')
+    crawl.add_argument('--output', help='Once every tenant is done, export the results to this file.')
+    crawl.add_argument('--format', default='csv', choices=formats, help='Output format. Default csv.')
+    crawl.set_defaults(func=fcrawl)
+
+    watch = subparsers.add_parser('watch', help='Keep polling alerts and report new and resolved ones until '
+                                                'interrupted.')
+    watch.add_argument('--tenant', action='append', help='Tenant id to watch, may be repeated. Default the '
+                                                         'current tenant.')
+    watch.add_argument('--all-tenants', action='store_true', help='Watch every tenant of the partner.')
+    watch.add_argument('--jsonl', help='Append events to this JSON Lines file.')
+    watch.add_argument('--webhook', help='POST events as JSON to this url.')
+    watch.add_argument('--quiet', action='store_true', help="Don't print events to stdout.")
+    watch.add_argument('--initial', action='store_true', help='Also report alerts that exist when watching starts.')
+    watch.add_argument('--min-interval', type=float, default=30, help='Seconds between polls of an active tenant. '
+                                                                      'Default 30.')
+    watch.add_argument('--max-interval', type=float, default=900, help='Longest seconds between polls of a quiet '
+                                                                       'tenant. Default 900.')
+    watch.set_defaults(func=fwatch)
 
     tenant = subparsers.add_parser('tenant', help='List tenants or become tenant.')
     tenant = tenant.add_subparsers(title='tenant commands.')
@@ -117,77 +221,221 @@ def parse_cli():
     tenant_enter.add_argument('id', help='id of tenant to enter.')
     tenant_exit = tenant.add_parser('exit', help="Leave the current tenant and become partner level.")
     tenant_exit.set_defaults(func=ftenant_exit)
-    args = parser.parse_args()
+    return parser.parse_args()
+
+
+def run(args) -> None:
     if hasattr(args, 'func'):
-        print(args.func(args))
+        result = args.func(args)
+        if result is None or isinstance(result, str):
+            print(result)
+        else:
+            # Listing commands yield lines so output starts with the first page
+            for line in result:
+                print(line, end='', flush=True)
     else:
         print("use -h or --help for information on how to use this program.")
 
 
+def current_tenant():
+    """The entered tenant, built from the cached apiHost when there is one so the partner api is skipped."""
+    cached = get_cache().tenant(identity, fresh=False)
+    if cached is None:
+        tenant = get_client()[identity]
+        get_cache().put_tenant(tenant)
+        return tenant
+    return get_client().tenant(cached['id'], cached['apiHost'], cached['name'], on_moved=get_cache().put_tenant)
+
+
 def fcache_clear(args) -> str:
-    for k in cache.keys():
-        del cache[k]
-    cache.sync()
+    get_cache().clear()
     return 'Cache cleared!'
 
 
-def fendpoint_list(args) -> str:
+def fcache_stats(args) -> str:
     val = ""
+    stats = get_cache().stats()
+    val = val + f"{stats['file']['path']}\t{stats['file']['bytes']} bytes\n"
+    val = val + f"{'Resource'.ljust(10)}\tRows\tFresh\tTTL\tOldest\tNewest\n"
+    for resource in ('tenants', 'endpoints', 'alerts'):
+        s = stats[resource]
+        val = val + (f"{resource.ljust(10)}\t{s['rows']}\t{s['fresh']}\t{s['ttl']}s\t"
+                     f"{s['oldest_age'] if s['oldest_age'] is not None else '-'}s\t"
+                     f"{s['newest_age'] if s['newest_age'] is not None else '-'}s\n")
+    return val
+
+
+def warm_tenant(tenant) -> str:
+    endpoints = sum(1 for _ in get_cache().record_endpoints(tenant.id, tenant.endpoints.iter_all(pipelined=True)))
+    alerts = sum(1 for _ in get_cache().record_alerts(tenant.id, tenant.alerts.iter_all(pipelined=True)))
+    return f"{endpoints} endpoints, {alerts} alerts"
+
+
+def fcache_warm(args) -> Iterator[str]:
+    tenants = get_client().tenants
+    get_cache().put_tenants(tenants.values())
+    yield f"Cached {len(tenants)} tenants\n"
+    if args.all_tenants:
+        for tenant, counts, error in get_client().fan_out(warm_tenant, tenants.values()):
+            yield f"{tenant.id}\t{tenant.name}\t{error or counts}\n"
+    elif identity is not None:
+        yield f"{identity}\t{warm_tenant(current_tenant())}\n"
+
+
+def endpoint_filters(args) -> dict:
+    """endpoint_query keyword arguments from endpoint list options, empty when nothing is filtered."""
+    filters = {'health': args.health and args.health.split(','),
+               'type': args.type and args.type.split(','),
+               'last_seen_before': args.last_seen_before,
+               'last_seen_after': args.last_seen_after,
+               'hostname': args.hostname,
+               'group': args.group,
+               'tamper_protection': None if args.tamper_protection is None else args.tamper_protection == 'on',
+               'search': args.search}
+    return dict([(k, v) for k, v in filters.items() if v is not None])
+
+
+def fendpoint_list(args) -> Iterator[str]:
+    from sophosApi.endpointApi import endpoint_query
+    filters = endpoint_filters(args)
+    fields = None if args.fields is None else [field.strip() for field in args.fields.split(',')]
+    query = endpoint_query(fields=fields, **filters)
+
+    def listing(tenant, pipelined=False):
+        # Only a complete, unprojected listing may replace the cached one
+        if filters or fields:
+            return tenant.endpoints.iter_all(query, pipelined)
+        return get_cache().record_endpoints(tenant.id, tenant.endpoints.iter_all(query, pipelined))
+
+    if fields:
+        describe = lambda e: '\t'.join(str(getattr(e, field)) for field in fields)
+        header = '\t'.join(fields)
+    else:
+        describe = lambda e: e.hostname or getattr(e, 'ipAddresses', '??????')
+        header = 'Hostname'
+    if args.all_tenants:
+        yield from fall_tenants_list(get_client().fan_out(lambda t: list(listing(t))), header, describe)
+        return
     if identity is None:
         raise Exception('Must become tenant before listing endpoints!')
-    endpoints = client[identity].endpoints.fetch_all()
-    val = val + f"{'Id'.ljust(36)}\tHostname\n"
-    for endpoint in endpoints:
-        val = val + f"{endpoint.id}\t{endpoint.hostname or getattr(endpoint, 'ipAddresses', '??????')}\n"
-    return val
+    yield f"{'Id'.ljust(36)}\t{header}\n"
+    for endpoint in listing(current_tenant(), pipelined=True):
+        yield f"{endpoint.id}\t{describe(endpoint)}\n"
+
+
+def fendpoint_find(args) -> Iterator[str]:
+    if identity is None:
+        raise Exception('Must become tenant before finding endpoints!')
+    tenant = current_tenant()
+    endpoints = get_cache().endpoints(identity)
+    if endpoints is None:
+        endpoints = get_cache().record_endpoints(identity, tenant.endpoints.iter_all(pipelined=True))
+    tenant.endpoints.load(endpoints)
+    if args.count_by is not None:
+        yield f"{args.count_by.ljust(36)}\tCount\n"
+        counts = tenant.endpoints.count_by(args.count_by)
+        for value, count in sorted(counts.items(), key=lambda item: -item[1]):
+            yield f"{str(value).ljust(36)}\t{count}\n"
+        return
+    criteria = dict([(name, getattr(args, name)) for name in endpoint_indexed if getattr(args, name) is not None])
+    yield f"{'Id'.ljust(36)}\tHostname\n"
+    for endpoint in tenant.endpoints.find(**criteria):
+        yield f"{endpoint.id}\t{endpoint.hostname or getattr(endpoint, 'ipAddresses', '??????')}\n"
+
+
+def fall_tenants_list(results, header, describe) -> Iterator[str]:
+    yield f"{'Tenant'.ljust(36)}\t{'Id'.ljust(36)}\t{header}\n"
+    errors = list()
+    for tenant, records, error in results:
+        if error is not None:
+            errors.append(f"{tenant.id}\t{tenant.name}\t{error}\n")
+            continue
+        for record in records:
+            yield f"{tenant.id}\t{record.id}\t{describe(record)}\n"
+    if errors:
+        yield f"\n{len(errors)} tenant(s) failed:\n"
+        yield from errors
 
 
 def fendpoint_detail(args) -> str:
     val = ""
     if identity is None:
         raise Exception('Must become tenant before listing endpoints!')
-    endpoint = client[identity].endpoints[args.id]
+    endpoint = get_cache().endpoint(args.id)
+    if endpoint is None:
+        endpoint = current_tenant().endpoints[args.id]
+        get_cache().put_endpoints(identity, [endpoint])
     pad = max([len(k) for k in endpoint.__annotations__.keys()]) + 1
     for x in list(endpoint.__annotations__.keys()):
         val = val + f"{x.ljust(pad)}\t{getattr(endpoint, x)}\n"
     return val
 
 
-def fendpoint_scan(args) -> str:
-    val = ""
+def add_bulk_arguments(parser, verb) -> None:
+    parser.add_argument('ids', nargs='*', help=f"ids of endpoints to {verb}, - reads ids from stdin")
+    parser.add_argument('--file', help='File with one endpoint id per line.')
+    parser.add_argument('--health', choices=['good', 'suspicious', 'bad', 'unknown'],
+                        help=f"{verb.capitalize()} every endpoint with this overall health.")
+    parser.add_argument('--group', help=f"{verb.capitalize()} every endpoint in this group.")
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent requests. Default 8.')
+    parser.add_argument('--dry-run', action='store_true', help='Show what would be done without doing it.')
+
+
+def bulk_endpoint_ids(args, tenant) -> List[str]:
+    ids = [i for i in args.ids if i != '-']
+    if '-' in args.ids:
+        ids.extend(line.strip() for line in sys.stdin if line.strip())
+    if args.file is not None:
+        with open(args.file) as f:
+            ids.extend(line.strip() for line in f if line.strip())
+    if args.health is not None or args.group is not None:
+        endpoints = tenant.endpoints.search(health=args.health, group=args.group, fields=['group'])
+        ids.extend(e.id for e in endpoints if args.group is None or e.group == args.group)
+    if not ids:
+        raise ValueError('No endpoints given. Pass ids, --file, --health or --group.')
+    return ids
+
+
+def fendpoint_bulk(args, action, verb) -> Iterator[str]:
     if identity is None:
-        raise Exception('Must become tenant before scanning endpoints!')
-    endpoint = client[identity].endpoints[args.id]
-    result = client[identity].endpoints.scan(args.id)
-    if result:
-        val = val + "Sophos reported scan is queued."
+        raise Exception('Must become tenant before acting on endpoints!')
+    tenant = current_tenant()
+    ids = bulk_endpoint_ids(args, tenant)
+    failed = 0
+    for result in action(tenant.endpoints)(ids, args.workers, args.dry_run):
+        if result.status == 'dry run':
+            outcome = 'dry run'
+        elif result.ok:
+            outcome = 'queued'
+        else:
+            failed += 1
+            outcome = f"failed: {result.error}"
+        yield f"{result.id}\t{outcome}\n"
+    if args.dry_run:
+        yield f"Would {verb} {len(set(ids))} endpoints.\n"
     else:
-        val = val + "Sophos reported scan failed to queue."
-    return val
+        yield f"Sophos reported {verb} queued on {len(set(ids)) - failed} of {len(set(ids))} endpoints.\n"
 
 
-def fendpoint_update(args) -> str:
-    val = ""
-    if identity is None:
-        raise Exception('Must become tenant before updating endpoints!')
-    endpoint = client[identity].endpoints[args.id]
-    result = client[identity].endpoints.update_agent(args.id)
-    if result:
-        val = val + "Sophos reported update is queued."
-    else:
-        val = val + "Sophos reported update failed to queue."
-    return val
+def fendpoint_scan(args) -> Iterator[str]:
+    return fendpoint_bulk(args, lambda e: e.scan_many, 'scan')
+
+
+def fendpoint_update(args) -> Iterator[str]:
+    return fendpoint_bulk(args, lambda e: e.update_many, 'update')
 
 
 def falert_action(args) -> str:
     val = ""
     if identity is None:
         raise Exception('Must become tenant before actioning alerts!')
-    alert = client[identity].alerts[args.id]
+    tenant = current_tenant()
+    alert = tenant.alerts[args.id]
     if args.action not in alert.allowedActions:
         raise ValueError(f"{args.action} not allowed on alert {alert.id}. Choose from {alert.allowedActions}")
-    result = client[identity].alerts.action(alert.id, args.action)
+    result = tenant.alerts.action(alert.id, args.action)
     if result:
+        get_cache().forget_alert(alert.id)
         val = val + f"Sophos reported action {args.action} is queued."
     else:
         val = val + f"Sophos report action {args.action} failed to be queued."
@@ -198,40 +446,181 @@ def falert_detail(args) -> str:
     val = ""
     if identity is None:
         raise Exception('Must become tenant before viewing alerts!')
-    alert = client[identity].alerts[args.id]
+    alert = get_cache().alert(args.id)
+    if alert is None:
+        alert = current_tenant().alerts[args.id]
+        get_cache().put_alerts(identity, [alert])
     pad = max([len(k) for k in alert.__annotations__.keys()]) + 1
     for x in list(alert.__annotations__.keys()):
         val = val + f"{x.ljust(pad)}\t{getattr(alert, x)}\n"
     return val
 
 
+def print_profile(fmt: str, elapsed: float) -> None:
+    from sophosApi.metrics import metrics
+    if fmt == 'json':
+        print(metrics.to_json(), file=sys.stderr)
+    elif fmt == 'prometheus':
+        print(metrics.to_prometheus(), end='', file=sys.stderr)
+    else:
+        print(f"\nWall: {elapsed:.2f}s\n{metrics.summary()}", end='', file=sys.stderr)
+
+
 def main():
+    started = perf_counter()
+    args = parse_cli()
     parse_config(get_config())
-    if cache.get('tenants') is None:
-        d = dict([(t.id, {'name': t.name, 'apiHost': t.apiHost, 'id': t.id}) for t in client.tenants.values()])
-        cache['tenants'] = d
-        cache.sync()
-    parse_cli()
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            print_profile(args.profile_format, perf_counter() - started)
 
 
 def ftenant_list(args) -> str:
     val = ""
-    tenants = cache['tenants'].values()
+    tenants = get_cache().tenants()
+    if tenants is None:
+        get_cache().put_tenants(get_client().tenants.values())
+        tenants = get_cache().tenants()
+    tenants = tenants.values()
     val = val + f"{'Id'.ljust(36)}\tName\n"
     for tenant in tenants:
         val = val + f"{tenant['id']}\t{tenant['name']}\n"
     return val
 
 
-def falert_list(args) -> str:
-    val = ""
+def falert_list(args) -> Iterator[str]:
+    if args.all_tenants:
+        results = get_client().fan_out(lambda t: list(get_cache().record_alerts(t.id, t.alerts.iter_all())))
+        yield from fall_tenants_list(results, 'Desc', lambda a: a.description)
+        return
     if identity is None:
         raise Exception('Must become tenant before viewing alerts!')
-    alerts = client[identity].alerts.fetch_all()
-    val = val + f"{'Id'.ljust(36)}\tDesc\n"
-    for alert in alerts:
-        val = val + f"{alert.id}\t{alert.description}\n"
-    return val
+    yield f"{'Id'.ljust(36)}\tDesc\n"
+    for alert in get_cache().record_alerts(identity, current_tenant().alerts.iter_all(pipelined=True)):
+        yield f"{alert.id}\t{alert.description}\n"
+
+
+def fexport(args):
+    from sophosApi.commonApi import Alert
+    from sophosApi.endpointApi import Endpoint
+    from sophosApi.export import export_records, stream_tenant_records
+    if args.all_tenants:
+        records = stream_tenant_records(get_client(), args.resource)
+    elif identity is None:
+        raise Exception('Must become tenant before exporting, or use --all-tenants!')
+    elif args.resource == 'endpoints':
+        records = current_tenant().endpoints.iter_all(pipelined=True)
+    else:
+        records = current_tenant().alerts.iter_all(pipelined=True)
+    fields = None if args.fields is None else [field.strip() for field in args.fields.split(',')]
+    count = export_records(records, args.output, args.format, fields, args.compress,
+                           record=Endpoint if args.resource == 'endpoints' else Alert)
+    if args.output == '-':
+        print(f"Exported {count} {args.resource}", file=sys.stderr)
+        return []
+    return f"Exported {count} {args.resource} to {args.output}"
+
+
+def fcrawl(args) -> Iterator[str]:
+    from sophosApi.commonApi import Alert
+    from sophosApi.crawl import Crawl
+    from sophosApi.endpointApi import Endpoint
+    from sophosApi.export import export_records
+    crawl = Crawl(get_client(), get_cache(), args.resource, args.name, max_workers=args.workers)
+    yield f"{'Tenant'.ljust(36)}\t{args.resource.capitalize()}\tStatus\n"
+    try:
+        for tenant, records, done, error in crawl.run(args.restart):
+            yield f"{tenant.id}\t{records}\t{'done' if done else f'failed: {error}'}\n"
+    except KeyboardInterrupt:
+        yield 'Interrupted.\n'
+    status = crawl.status()
+    yield f"{status['done']} of {status['tenants']} tenants done, {status['records']} {args.resource}\n"
+    if not crawl.finished():
+        yield "Run again to resume.\n"
+    elif args.output:
+        count = export_records((record for t_id, record in crawl.results()), args.output, args.format,
+                               record=Endpoint if args.resource == 'endpoints' else Alert)
+        yield f"Exported {count} {args.resource} to {args.output}\n"
+
+
+def falert_bulk_action(args) -> Iterator[str]:
+    from sophosApi.commonApi import AlertActionReport, alert_filter
+    matches = alert_filter(args.filter)
+
+    def action_tenant(tenant) -> AlertActionReport:
+        alerts = get_cache().alerts(tenant.id)
+        if alerts is None:
+            alerts = list(get_cache().record_alerts(tenant.id, tenant.alerts.iter_all(pipelined=True)))
+        report = tenant.alerts.action_many(filter(matches, alerts), args.action, args.workers, args.dry_run)
+        if not args.dry_run:
+            for a_id in report.succeeded:
+                get_cache().forget_alert(a_id)
+        return report
+
+    if args.all_tenants:
+        results = get_client().fan_out(action_tenant)
+    elif identity is None:
+        raise Exception('Must become tenant before actioning alerts, or use --all-tenants!')
+    else:
+        tenant = current_tenant()
+        results = [(tenant, action_tenant(tenant), None)]
+    totals = [0, 0, 0]
+    yield f"{'Tenant'.ljust(36)}\t{'Would action' if args.dry_run else 'Actioned'}\tFailed\tNot allowed\n"
+    for tenant, report, error in results:
+        if error is not None:
+            yield f"{tenant.id}\tfailed: {error}\n"
+            continue
+        counts = [len(report.succeeded), len(report.failed), len(report.skipped)]
+        totals = [t + c for t, c in zip(totals, counts)]
+        yield f"{tenant.id}\t{counts[0]}\t{counts[1]}\t{counts[2]}\n"
+        for result in report.failed:
+            yield f"  {result.id}\t{result.error}\n"
+    yield f"{'Total'.ljust(36)}\t{totals[0]}\t{totals[1]}\t{totals[2]}\n"
+
+
+def falert_sync(args) -> Iterator[str]:
+    full_every = 0 if args.full else 3600
+    if args.all_tenants:
+        results = get_client().fan_out(lambda t: get_cache().sync_alerts(t.id, t.alerts, full_every))
+    elif identity is None:
+        raise Exception('Must become tenant before syncing alerts!')
+    else:
+        tenant = current_tenant()
+        results = [(tenant, get_cache().sync_alerts(tenant.id, tenant.alerts, full_every), None)]
+    for tenant, delta, error in results:
+        if error is not None:
+            yield f"!\t{tenant.id}\t{error}\n"
+            continue
+        for alert in delta.added:
+            yield f"+\t{tenant.id}\t{alert.id}\t{alert.description}\n"
+        for a_id in delta.removed:
+            yield f"-\t{tenant.id}\t{a_id}\n"
+
+
+def fwatch(args) -> str:
+    from sophosApi.watch import Watcher, jsonl_sink, stdout_sink, webhook_sink
+    if args.all_tenants:
+        tenants = None
+    elif args.tenant:
+        tenants = [get_client()[t_id] for t_id in args.tenant]
+    elif identity is None:
+        raise Exception('Must become tenant before watching, or use --tenant or --all-tenants!')
+    else:
+        tenants = [current_tenant()]
+    sinks = [] if args.quiet else [stdout_sink()]
+    if args.jsonl:
+        sinks.append(jsonl_sink(args.jsonl))
+    if args.webhook:
+        sinks.append(webhook_sink(args.webhook))
+    watcher = Watcher(get_client(), get_cache(), tenants, sinks, args.min_interval, args.max_interval,
+                      emit_initial=args.initial)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return 'Stopped watching.'
 
 
 def ftenant_enter(args) -> None: